@@ -1,14 +1,20 @@
 import sys
-import importlib.resources
+import functools
+import concurrent.futures
 import subprocess
 import argparse
 import pathlib
+import time
 import traceback
 import logging
+from typing import Iterable
 
 import sllm.api
+import sllm.broker
 import sllm.common
 import sllm.container
+import sllm.trace
+import _sllm_git_message.pending
 
 logger = logging.getLogger(__name__)
 
@@ -47,6 +53,37 @@ def read_from_ref(reference: str) -> str:
     return proc.stdout.strip()
 
 
+def read_from_range(revision_range: str) -> list[tuple[str, str]]:
+    """Read git messages of all commits in a range.
+
+    Merge commits and commits with empty messages are skipped.
+
+    :param revision_range: Anything 'git log' accepts, e.g. 'main..HEAD'.
+    :returns: Commit hashes and messages, oldest first.
+    """
+    cmd = ["git", "log", "-z", "--no-merges", "--reverse"]
+    cmd += ["--format=%H%x1f%B", revision_range]
+
+    proc = subprocess.run(cmd, text=True, capture_output=True)
+    if proc.returncode > 0:
+        logger.error(
+            f"Got {proc.returncode} from 'git log': {proc.stderr.strip()}"
+        )
+        raise RuntimeError("Could not read range.")
+
+    commits: list[tuple[str, str]] = []
+    for record in proc.stdout.split("\0"):
+        if not record.strip():
+            continue
+        commit, _, message = record.partition("\x1f")
+        message = message.strip()
+        if not message:
+            logger.debug(f"Skipping commit {commit} with empty message.")
+            continue
+        commits.append((commit.strip(), message))
+    return commits
+
+
 def communicate_request(message: str) -> None:
     """Formats the commit message and prints it."""
     # TODO Wrap long lines
@@ -56,15 +93,16 @@ def communicate_request(message: str) -> None:
         print("\033[0m" if sllm.common.use_color() else "", end="\n")
 
 
+def is_ok(text: str) -> bool:
+    """Determine whether the review is positive."""
+    return "meh" not in text.lower()
+
+
 def communicate_response(review: str) -> bool:
     """Communitcates the LLM response to the user.
 
     :returns: True if the code is considered good.
     """
-
-    def is_ok(text: str) -> bool:
-        return "meh" not in text.lower()
-
     for line in review.split("\n"):
         if sllm.common.use_color():
             print("\033[32m" if is_ok(line) else "\033[31m", end="")
@@ -74,14 +112,258 @@ def communicate_response(review: str) -> bool:
     return is_ok(review)
 
 
-def app() -> None:
+def communicate_response_stream(chunks: Iterable[str]) -> str:
+    """Communicates the LLM response to the user as it is generated.
+
+    Lines are printed as OK until they turn out not to be.
+
+    :returns: The whole response.
+    """
+    review: str = ""
+    line: str = ""
+    for chunk in chunks:
+        review += chunk
+
+        for i, part in enumerate(chunk.split("\n")):
+            if i > 0:
+                print("\033[0m" if sllm.common.use_color() else "", end="\n")
+                line = ""
+            if not part:
+                continue
+            line += part
+            if sllm.common.use_color():
+                print("\033[32m" if is_ok(line) else "\033[31m", end="")
+            print(part, end="", flush=True)
+
+    print("\033[0m" if sllm.common.use_color() else "", end="\n")
+    return review.strip()
+
+
+@functools.cache
+def prompt() -> str:
+    """Load the instructions for the model.
+
+    The file is read once per process, '--range' builds many requests.
+    """
+    # Not through 'importlib.resources', importing it is slow
+    return pathlib.Path(__file__).with_name("prompt.txt").read_text()
+
+
+def build_request(
+    message: str,
+    *,
+    cache: bool,
+    priority: int = sllm.broker.PRIORITY_INTERACTIVE,
+) -> sllm.api.Request:
+    """Build a review request for a commit message."""
+    return sllm.api.Request(
+        prompt=prompt(),
+        query=message,
+        example_input_header="[Instruction]",
+        example_response_header="[Review]",
+        # Three short lines; anything after the third is made up
+        max_tokens=256,
+        stop=["\n4.", "\n["],
+        cache=cache,
+        prefix_cache=True,
+        priority=priority,
+    )
+
+
+def review_range(revision_range: str, *, jobs: int, cache: bool) -> bool:
+    """Review all commits in a range.
+
+    Reviews run concurrently, but they are printed in commit order.
+
+    :param revision_range: Anything 'git log' accepts, e.g. 'main..HEAD'.
+    :param jobs: How many reviews to run at the same time.
+    :param cache: Reuse old reviews.
+    :returns: True if all commits are considered good.
+    """
+    commits: list[tuple[str, str]] = read_from_range(revision_range)
+    if not commits:
+        logger.info("There are no commits to review.")
+        return True
+
+    reviews: list[sllm.api.Request] = [
+        build_request(message, cache=cache, priority=sllm.broker.PRIORITY_BATCH)
+        for _, message in commits
+    ]
+    if sllm.broker.available():
+        logger.debug("Broker is running, it takes care of the runtime.")
+    elif any(request.cached() is None for request in reviews):
+        sllm.container.ensure_runtime()
+        sllm.container.ensure_started()
+        # Verify the model once, instead of in every worker
+        if not sllm.api.ok():
+            raise RuntimeError("Model is malfunctioning.")
+
+    logger.info(f"Rating {len(commits)} commits...")
+    all_ok: bool = True
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    try:
+        futures = [pool.submit(request.send) for request in reviews]
+        for (commit, message), future in zip(commits, futures):
+            review: str = future.result()
+            print(commit[:12])
+            communicate_request(message)
+            if not communicate_response(review):
+                logger.warning(f"Commit {commit[:12]} should be reworded.")
+                all_ok = False
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+    return all_ok
+
+
+def review_in_background(message: str, *, cache: bool) -> None:
+    """Hand the message over to a detached worker and return.
+
+    The review is attached to the commit as a git note once both of
+    them exist; see 'review_pending()' and 'show_pending()'.
+    """
+    repository: str = _sllm_git_message.pending.toplevel()
+    review = _sllm_git_message.pending.Review(
+        repository,
+        message,
+        cache=cache,
+        head=_sllm_git_message.pending.head(repository),
+    )
+    review.save()
+    sllm.common.detach(
+        "import _sllm_git_message; "
+        f"_sllm_git_message.review_pending({review.key!r})",
+        cwd=review.repository,
+    )
+    logger.info("Reviewing in the background, see '--pending' later.")
+
+
+def review_pending(key: str) -> None:
+    """Review a message from the pending area.
+
+    This runs in the worker started by 'review_in_background()'. Errors
+    are stored with the review, nobody is watching the output.
+
+    :param key: Key of the pending review.
+    """
+    path: pathlib.Path = _sllm_git_message.pending.directory() / f"{key}.json"
+    review = _sllm_git_message.pending.Review.load(path)
+    try:
+        request = build_request(
+            review.message,
+            cache=review.cache,
+            priority=sllm.broker.PRIORITY_BATCH,
+        )
+        if request.cached() is None and not sllm.broker.available():
+            sllm.container.ensure_runtime()
+            sllm.container.ensure_started()
+        review.review = request.send()
+        review.ok = is_ok(review.review)
+    except Exception as exc:
+        review.error = f"{exc.__class__.__name__} {exc}"
+    review.save()
+    if review.error is not None:
+        return
+
+    # Cached reviews can finish before git creates the commit
+    deadline: float = time.monotonic() + _sllm_git_message.pending.COMMIT_WAIT
+    while not _sllm_git_message.pending.attach(review):
+        if time.monotonic() > deadline:
+            logger.debug("Commit did not appear, the review stays pending.")
+            return
+        time.sleep(1)
+
+
+def show_pending() -> bool:
+    """Show the reviews finished in the background.
+
+    Shown reviews are removed from the pending area. Those attached to
+    their commits can be shown again by 'git log --notes=sllm'.
+
+    :returns: True if all shown commits are considered good.
+    """
+    reviews: list[_sllm_git_message.pending.Review] = (
+        _sllm_git_message.pending.reviews(_sllm_git_message.pending.toplevel())
+    )
+    if not reviews:
+        logger.info("There are no pending reviews.")
+        return True
+
+    all_ok: bool = True
+    for review in reviews:
+        title: str = review.message.split("\n")[0]
+        if not review.finished:
+            logger.info(f"Review of '{title}' is still running.")
+            continue
+        if review.error is None and review.commit is None:
+            # The worker may have given up before the commit appeared
+            _sllm_git_message.pending.attach(review)
+
+        print(review.commit[:12] if review.commit else "(not committed)")
+        communicate_request(review.message)
+        if review.review is not None:
+            if not communicate_response(review.review):
+                all_ok = False
+        else:
+            logger.error(f"Review failed: {review.error}")
+        review.remove()
+
+    return all_ok
+
+
+def app() -> int:
     parser = argparse.ArgumentParser()
     flags = parser.add_mutually_exclusive_group()
     flags.add_argument("--ref", help="load from commit", type=str)
     flags.add_argument("--file", help="load from file", type=pathlib.Path)
+    flags.add_argument("--range", help="load from commit range", type=str)
+    flags.add_argument(
+        "--pending",
+        action="store_true",
+        help="show reviews finished in the background",
+    )
+    flags.add_argument(
+        "--warm",
+        action="store_true",
+        help="start the model in the background, for prepare-commit-msg",
+    )
+    parser.add_argument(
+        "--jobs",
+        help="reviews to run at once, with --range",
+        type=int,
+        default=sllm.common.CAPACITY,
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="do not reuse old reviews"
+    )
+    parser.add_argument(
+        "--background",
+        action="store_true",
+        help="review in a detached process and store the review as a git "
+        "note, with --file",
+    )
+    parser.add_argument(
+        "--timings", action="store_true", help="show how long each phase took"
+    )
     parser.add_argument("--debug", action="store_true", help="nerd information")
 
     args = parser.parse_args()
+    if args.background and args.file is None:
+        parser.error("--background can only be used with --file")
+
+    if args.pending:
+        return 0 if show_pending() else 1
+
+    if args.warm:
+        # The user is about to write the message, it is not needed yet
+        sllm.container.warm_up(background=True)
+        return 0
+
+    if args.range is not None:
+        ok: bool = review_range(
+            args.range, jobs=max(args.jobs, 1), cache=not args.no_cache
+        )
+        return 0 if ok else 1
 
     message: str
     if args.ref is not None:
@@ -90,43 +372,50 @@ def app() -> None:
         message = read_from_file(args.file)
     else:
         parser.print_help()
-        return
+        return 0
 
     if not len(message):
         logger.info("The message is empty.")
-        return
+        return 0
 
-    sllm.container.ensure_runtime()
-    sllm.container.ensure_started()
-    sllm.container.schedule_shutdown()
+    if args.background:
+        review_in_background(message, cache=not args.no_cache)
+        return 0
 
-    communicate_request(message)
+    request = build_request(message, cache=not args.no_cache)
 
-    logger.info("Rating...")
-    request = sllm.api.Request(
-        prompt=(
-            importlib.resources.files("_sllm_git_message")
-            .joinpath("prompt.txt")
-            .read_text()
-        ),
-        query=message,
-        example_input_header="[Instruction]",
-        example_response_header="[Review]",
-    )
-    review: str = request.send()
+    review: str | None = request.cached()
+    if review is not None:
+        communicate_request(message)
+        # Answered from the cache, but counted in the statistics
+        ok = communicate_response(request.send())
+    else:
+        if not sllm.broker.available():
+            sllm.container.ensure_runtime()
+            sllm.container.ensure_started()
+
+        communicate_request(message)
+
+        logger.info("Rating...")
+        review = communicate_response_stream(request.stream())
+        ok = is_ok(review)
 
-    ok: bool = communicate_response(review)
     if not ok:
         logger.warning("You should use '--amend' to rewrite the message.")
+    # The hook must not block the commit
+    return 0
 
 
 def main() -> int:
     debug: bool = "--debug" in sys.argv
+    timings: bool = "--timings" in sys.argv
     sllm.common.configure_logging(debug=debug)
+    if timings:
+        sllm.trace.enable()
 
     try:
-        app()
-        return 0
+        with sllm.trace.span("total"):
+            return app()
     except KeyboardInterrupt:
         logger.error("Interrupted.")
         return 0
@@ -137,3 +426,6 @@ def main() -> int:
         else:
             print(exc.__class__.__name__, exc)
         return 1
+    finally:
+        if timings:
+            print(sllm.trace.report(), file=sys.stderr)
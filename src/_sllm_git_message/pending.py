@@ -0,0 +1,199 @@
+"""Reviews running in the background of 'git commit'.
+
+The commit-msg hook runs before the commit exists, so the message is put
+into a pending area and reviewed by a detached worker. Once the commit
+appears, the review is attached to it as a git note. Finished reviews
+stay in the pending area until they are shown.
+"""
+
+import dataclasses
+import hashlib
+import json
+import logging
+import pathlib
+import re
+import subprocess
+import time
+
+import sllm.common
+
+
+NOTES_REF: str = "sllm"
+# Reviews of commits that never happened are dropped after a week
+EXPIRE: int = 7 * 24 * 3600
+# How long the worker waits for git to create the commit, in seconds
+COMMIT_WAIT: float = 30.0
+
+logger = logging.getLogger(__name__)
+
+
+def directory() -> pathlib.Path:
+    """Get the directory holding the pending reviews."""
+    path = sllm.common.cache_dir() / "pending"
+    path.mkdir(exist_ok=True)
+    return path
+
+
+def _git(repository: str, *args: str) -> subprocess.CompletedProcess[str]:
+    return subprocess.run(
+        ["git", *args], cwd=repository, text=True, capture_output=True
+    )
+
+
+def toplevel() -> str:
+    """Find the top-level directory of the current repository.
+
+    :raises RuntimeError: Not in a git repository.
+    """
+    proc = subprocess.run(
+        ["git", "rev-parse", "--show-toplevel"], text=True, capture_output=True
+    )
+    if proc.returncode > 0:
+        raise RuntimeError(f"Not in a git repository: {proc.stderr.strip()}")
+    return proc.stdout.strip()
+
+
+def head(repository: str) -> str | None:
+    """Get the commit the repository is at.
+
+    :returns: Hash of the commit, or None if there are no commits yet.
+    """
+    proc = _git(repository, "rev-parse", "--verify", "--quiet", "HEAD")
+    if proc.returncode > 0:
+        return None
+    return proc.stdout.strip()
+
+
+def _normalize(message: str) -> str:
+    # Same as the default cleanup of 'git commit', without the comments
+    lines: list[str] = [line.rstrip() for line in message.split("\n")]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+@dataclasses.dataclass
+class Review:
+    """Review of a commit message, possibly not finished yet."""
+
+    repository: str
+    message: str
+    cache: bool = True
+    created: float = dataclasses.field(default_factory=time.time)
+    # Commit the repository was at when the message was written
+    head: str | None = None
+    commit: str | None = None
+    review: str | None = None
+    ok: bool | None = None
+    error: str | None = None
+
+    @property
+    def key(self) -> str:
+        raw: str = f"{self.repository}\0{_normalize(self.message)}"
+        return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+    @property
+    def path(self) -> pathlib.Path:
+        return directory() / f"{self.key}.json"
+
+    @property
+    def finished(self) -> bool:
+        return self.review is not None or self.error is not None
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> "Review":
+        """Load a review from the pending area.
+
+        :raises OSError: The review does not exist.
+        :raises ValueError: The file is damaged.
+        """
+        content: dict = json.loads(path.read_text())
+        return cls(**content)
+
+    def save(self) -> None:
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps(dataclasses.asdict(self)))
+        tmp.replace(self.path)
+
+    def remove(self) -> None:
+        self.path.unlink(missing_ok=True)
+
+
+def find_commit(review: Review, *, depth: int = 20) -> str | None:
+    """Find the commit created with the reviewed message.
+
+    Only the newest commits on the current branch are searched. Commits
+    that existed when the message was written are skipped: after
+    'git commit --amend', the old commit has the same message, and it is
+    there before git writes the new one.
+
+    :returns: Hash of the commit, if it exists.
+    """
+    since: list[str] = [f"^{review.head}"] if review.head else []
+    proc = _git(
+        review.repository,
+        "log",
+        "-z",
+        f"-n{depth}",
+        "--format=%H%x1f%B",
+        "HEAD",
+        *since,
+        "--",
+    )
+    if proc.returncode > 0:
+        logger.debug(f"Cannot list commits: {proc.stderr.strip()}")
+        return None
+    wanted: str = _normalize(review.message)
+    for record in proc.stdout.split("\0"):
+        commit, _, message = record.partition("\x1f")
+        if _normalize(message) == wanted:
+            return commit.strip()
+    return None
+
+
+def attach(review: Review) -> bool:
+    """Store the finished review as a git note of its commit.
+
+    :returns: True if the note has been stored.
+    """
+    if review.review is None:
+        return False
+    if review.commit is None:
+        review.commit = find_commit(review)
+        if review.commit is None:
+            return False
+
+    proc = _git(
+        review.repository,
+        "notes",
+        f"--ref={NOTES_REF}",
+        "add",
+        "--force",
+        "--message",
+        review.review,
+        review.commit,
+    )
+    if proc.returncode > 0:
+        logger.warning(f"Cannot store the review: {proc.stderr.strip()}")
+        return False
+    logger.debug(f"Review has been attached to {review.commit[:12]}.")
+    review.save()
+    return True
+
+
+def reviews(repository: str) -> list[Review]:
+    """Load the pending reviews of a repository, oldest first.
+
+    Reviews older than 'EXPIRE' are removed.
+    """
+    found: list[Review] = []
+    for path in directory().glob("*.json"):
+        try:
+            review: Review = Review.load(path)
+        except (OSError, ValueError, TypeError) as exc:
+            logger.debug(f"Skipping damaged review {path.name}: {exc}.")
+            continue
+        if review.created < time.time() - EXPIRE:
+            review.remove()
+            continue
+        if review.repository == repository:
+            found.append(review)
+    return sorted(found, key=lambda r: r.created)
@@ -1,16 +1,23 @@
 import sys
+import functools
+import concurrent.futures
+import pathlib
+import re
 import subprocess
 import tempfile
 import textwrap
+import threading
 import os
-import importlib.resources
 import argparse
 import traceback
 import logging
 
 import sllm.api
+import sllm.broker
 import sllm.common
 import sllm.container
+import sllm.trace
+import _sllm_translate.po
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +33,87 @@ def read_from_editor() -> str:
         return handle.read()
 
 
+def read_from_files(files: list[pathlib.Path]) -> str:
+    """Read text from files, '-' being the standard input."""
+    parts: list[str] = []
+    for file in files:
+        if str(file) == "-":
+            parts.append(sys.stdin.read())
+        else:
+            parts.append(file.read_text())
+    return "\n\n".join(parts)
+
+
+def _pieces(text: str, separator: str) -> list[tuple[str, str]]:
+    """Split text, keeping each separator with the piece before it.
+
+    :param separator: Regular expression without groups.
+    """
+    parts: list[str] = re.split(f"({separator})", text)
+    return list(zip(parts[0::2], parts[1::2] + [""]))
+
+
+def _pack(pieces: list[tuple[str, str]], budget: int) -> list[tuple[str, str]]:
+    """Join consecutive pieces of text while they fit into the budget.
+
+    Pieces are joined with their original separators.
+
+    :param pieces: Pieces, each with the separator that follows it.
+    :returns: Joined pieces, each with the separator that follows it.
+    """
+    packed: list[tuple[str, str]] = []
+    current: str = ""
+    after: str = ""
+    for piece, separator in pieces:
+        candidate: str = f"{current}{after}{piece}" if current else piece
+        if current and sllm.api.estimate_tokens(candidate) > budget:
+            packed.append((current, after))
+            current = piece
+        else:
+            current = candidate
+        after = separator
+    if current:
+        packed.append((current, after))
+    return packed
+
+
+def split(text: str, *, budget: int) -> list[tuple[str, str]]:
+    """Split text into chunks that can be translated separately.
+
+    Text is split at paragraph boundaries. Paragraphs that do not fit
+    into the budget are split into sentences, and sentences that do not
+    fit are split into words. Within a paragraph, the text between the
+    chunks is kept as it was, including line breaks.
+
+    :param budget: Maximal size of a chunk, in tokens.
+    :returns: Chunks, each with the separator that should follow it.
+    """
+    chunks: list[tuple[str, str]] = []
+    paragraphs: list[str] = [
+        p.strip() for p in re.split(r"\n\s*\n", text) if p.strip()
+    ]
+    for paragraph, _ in _pack([(p, "\n\n") for p in paragraphs], budget):
+        if sllm.api.estimate_tokens(paragraph) <= budget:
+            chunks.append((paragraph, "\n\n"))
+            continue
+
+        sentences: list[tuple[str, str]] = []
+        for sentence, separator in _pieces(paragraph, r"(?<=[.!?])\s+"):
+            if sllm.api.estimate_tokens(sentence) <= budget:
+                sentences.append((sentence, separator))
+                continue
+            words: list[tuple[str, str]] = _pieces(sentence, r"\s+")
+            words[-1] = (words[-1][0], separator)
+            sentences += _pack(words, budget)
+        chunks += _pack(sentences, budget)
+        # The paragraph ends with the last of its chunks
+        chunks[-1] = (chunks[-1][0], "\n\n")
+
+    if chunks:
+        chunks[-1] = (chunks[-1][0], "")
+    return chunks
+
+
 def communicate_request(message: str) -> None:
     """Formats the commit message and prints it."""
     if not sys.stdout.isatty():
@@ -41,6 +129,99 @@ def communicate_request(message: str) -> None:
             print("\033[0m" if sllm.common.use_color() else "", end="\n")
 
 
+def communicate_response(chunk: str) -> None:
+    """Prints a piece of the translation as soon as it arrives."""
+    print(chunk, end="", flush=True)
+
+
+@functools.cache
+def prompt(language: str = "English") -> str:
+    """Load the instructions for the model.
+
+    The file is read once per process, long texts build many requests.
+
+    :param language: Language to translate into.
+    """
+    # Not through 'importlib.resources', importing it is slow
+    template: str = pathlib.Path(__file__).with_name("prompt.txt").read_text()
+    return template.format(language=language)
+
+
+def build_request(
+    message: str, *, cache: bool, language: str = "English"
+) -> sllm.api.Request:
+    """Build a translation request.
+
+    :param language: Language to translate into.
+    """
+    return sllm.api.Request(
+        prompt=prompt(language),
+        query=message,
+        example_input_header="[Original]",
+        example_response_header="[Translation]",
+        # Translations are about as long as the original
+        max_tokens=2 * sllm.api.estimate_tokens(message) + 64,
+        stop=["[Original]"],
+        cache=cache,
+        prefix_cache=True,
+    )
+
+
+def translate_chunks(
+    chunks: list[tuple[str, str]], *, jobs: int, cache: bool
+) -> None:
+    """Translate chunks of text concurrently.
+
+    Translations are printed in the original order, each as soon as
+    it and all chunks before it are translated.
+
+    :param chunks: Chunks of text, as returned by 'split()'.
+    :param jobs: How many chunks to translate at the same time.
+    :param cache: Reuse old translations.
+    """
+    pending: list[sllm.api.Request] = [
+        build_request(chunk, cache=cache) for chunk, _ in chunks
+    ]
+    if sllm.broker.available():
+        logger.debug("Broker is running, it takes care of the runtime.")
+    elif any(request.cached() is None for request in pending):
+        sllm.container.ensure_runtime()
+        sllm.container.ensure_started()
+
+    logger.info(f"Translating {len(chunks)} parts...")
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    try:
+        futures = [pool.submit(request.send) for request in pending]
+        for (_, separator), future in zip(chunks, futures):
+            communicate_response(future.result() + separator)
+    finally:
+        pool.shutdown(cancel_futures=True)
+    print()
+
+
+def translate_catalog(path: pathlib.Path, *, jobs: int, cache: bool) -> None:
+    """Translate a gettext catalog in place.
+
+    See '_sllm_translate.po.translate()'.
+    """
+    lock = threading.Lock()
+    started: list[bool] = []
+
+    def translate_text(text: str, language: str) -> str:
+        request = build_request(text, cache=cache, language=language)
+        with lock:
+            # Only start the runtime when something is not cached
+            if not started and request.cached() is None:
+                if not sllm.broker.available():
+                    sllm.container.ensure_runtime()
+                    sllm.container.ensure_started()
+                started.append(True)
+        return request.send()
+
+    count: int = _sllm_translate.po.translate(path, translate_text, jobs=jobs)
+    logger.info(f"Translated {count} entries of {path}.")
+
+
 def app() -> None:
     parser = argparse.ArgumentParser(
         description=(
@@ -48,45 +229,105 @@ def app() -> None:
             "Leaving the input empty will open $EDITOR window."
         )
     )
+    parser.add_argument(
+        "--file",
+        help="read from file, '-' for stdin",
+        type=pathlib.Path,
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--po",
+        help=(
+            "translate changed entries of a gettext catalog in place, "
+            "into the language of the catalog"
+        ),
+        type=pathlib.Path,
+    )
+    parser.add_argument(
+        "--chunk-tokens",
+        help="split long input into parts of this size",
+        type=int,
+        default=512,
+    )
+    parser.add_argument(
+        "--jobs",
+        help="parts to translate at once",
+        type=int,
+        default=sllm.common.CAPACITY,
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="do not reuse old translations"
+    )
+    parser.add_argument(
+        "--timings", action="store_true", help="show how long each phase took"
+    )
     parser.add_argument("--debug", action="store_true", help="nerd information")
     parser.add_argument("input", nargs="*", help="read from argv")
 
     args = parser.parse_args()
 
+    if args.po is not None:
+        translate_catalog(
+            args.po, jobs=max(args.jobs, 1), cache=not args.no_cache
+        )
+        return
+
     message: str = ""
     if len(args.input):
-        message = " ".join(args.argv)
+        message = " ".join(args.input)
+    elif len(args.file):
+        message = read_from_files(args.file)
+    elif not sys.stdin.isatty():
+        message = sys.stdin.read()
     else:
         message = read_from_editor()
 
-    sllm.container.ensure_runtime()
-    sllm.container.ensure_started()
-    sllm.container.schedule_shutdown()
+    if not message.strip():
+        logger.info("The input is empty.")
+        return
+
+    chunks: list[tuple[str, str]] = split(
+        message, budget=max(args.chunk_tokens, 1)
+    )
+    if len(chunks) > 1:
+        communicate_request(message)
+        translate_chunks(
+            chunks, jobs=max(args.jobs, 1), cache=not args.no_cache
+        )
+        return
+
+    request = build_request(message, cache=not args.no_cache)
+
+    translation: str | None = request.cached()
+    if translation is not None:
+        communicate_request(message)
+        # Answered from the cache, but counted in the statistics
+        print(request.send())
+        return
+
+    if not sllm.broker.available():
+        sllm.container.ensure_runtime()
+        sllm.container.ensure_started()
 
     communicate_request(message)
 
     logger.info("Translating...")
-    request = sllm.api.Request(
-        prompt=(
-            importlib.resources.files("_sllm_translate")
-            .joinpath("prompt.txt")
-            .read_text()
-        ),
-        query=message,
-        example_input_header="[Original]",
-        example_response_header="[Translation]",
-    )
-    translation: str = request.send()
-    print(translation)
+    request.send(callback=communicate_response)
+    print()
 
 
 def main() -> int:
     debug: bool = "--debug" in sys.argv
+    timings: bool = "--timings" in sys.argv
     sllm.common.configure_logging(debug=debug)
+    if timings:
+        sllm.trace.enable()
 
     try:
-        app()
-        return 0
+        with sllm.trace.span("total"):
+            app()
+            return 0
     except KeyboardInterrupt:
         logger.error("Interrupted.")
         return 0
@@ -97,3 +338,6 @@ def main() -> int:
         else:
             print(exc.__class__.__name__, exc)
         return 1
+    finally:
+        if timings:
+            print(sllm.trace.report(), file=sys.stderr)
@@ -0,0 +1,382 @@
+"""Incremental translation of gettext catalogs.
+
+Only entries that are not translated, are fuzzy, or that were translated
+by a previous run for a different msgid are sent to the model. Finished
+translations are checkpointed, so an interrupted run resumes where it
+stopped.
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import logging
+import pathlib
+import re
+from typing import Callable
+
+import sllm.common
+
+
+logger = logging.getLogger(__name__)
+
+_KEYWORD = re.compile(r"^(msgctxt|msgid_plural|msgid|msgstr(?:\[(\d+)\])?)\s+")
+_ESCAPES: dict[str, str] = {"n": "\n", "t": "\t", '"': '"', "\\": "\\"}
+_LANGUAGE = re.compile(r"^Language:[ \t]*(\S*)", re.MULTILINE)
+# Names of common languages by their ISO 639 codes; the model knows the
+# names better than the codes
+LANGUAGES: dict[str, str] = {
+    "ar": "Arabic",
+    "bg": "Bulgarian",
+    "ca": "Catalan",
+    "cs": "Czech",
+    "da": "Danish",
+    "de": "German",
+    "el": "Greek",
+    "en": "English",
+    "es": "Spanish",
+    "et": "Estonian",
+    "fi": "Finnish",
+    "fr": "French",
+    "he": "Hebrew",
+    "hi": "Hindi",
+    "hr": "Croatian",
+    "hu": "Hungarian",
+    "id": "Indonesian",
+    "it": "Italian",
+    "ja": "Japanese",
+    "ko": "Korean",
+    "lt": "Lithuanian",
+    "lv": "Latvian",
+    "nb": "Norwegian Bokmål",
+    "nl": "Dutch",
+    "pl": "Polish",
+    "pt": "Portuguese",
+    "ro": "Romanian",
+    "ru": "Russian",
+    "sk": "Slovak",
+    "sl": "Slovenian",
+    "sr": "Serbian",
+    "sv": "Swedish",
+    "th": "Thai",
+    "tr": "Turkish",
+    "uk": "Ukrainian",
+    "vi": "Vietnamese",
+    "zh": "Chinese",
+}
+
+
+def _unquote(text: str) -> str:
+    text = text.strip()
+    if len(text) < 2 or text[0] != '"' or text[-1] != '"':
+        raise ValueError(f"Invalid string {text!r}.")
+    return re.sub(
+        r"\\(.)", lambda m: _ESCAPES.get(m.group(1), m.group(1)), text[1:-1]
+    )
+
+
+def _quote(text: str) -> str:
+    text = (
+        text.replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+    )
+    return f'"{text}"'
+
+
+def _fingerprint(*parts: str) -> str:
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()[:32]
+
+
+class Entry:
+    def __init__(self, lines: list[str]):
+        """Single entry of a catalog, including its comments.
+
+        :param lines: Raw lines of the entry, without line endings.
+        """
+        self.lines: list[str] = lines
+        self.msgctxt: str = ""
+        self.msgid: str = ""
+        self.msgid_plural: str | None = None
+        # Index is None for singular entries
+        self.msgstr: dict[int | None, str] = {}
+        self.obsolete: bool = False
+        self.fuzzy: bool = False
+        self._parse()
+
+    def _parse(self) -> None:
+        field: tuple[str, int | None] | None = None
+        for line in self.lines:
+            if line.startswith("#~"):
+                self.obsolete = True
+                continue
+            if line.startswith("#,"):
+                flags = [f.strip() for f in line[2:].split(",")]
+                self.fuzzy = "fuzzy" in flags
+                continue
+            if line.startswith("#"):
+                continue
+
+            match = _KEYWORD.match(line)
+            if match is not None:
+                keyword: str = match.group(1)
+                index: int | None = (
+                    int(match.group(2)) if match.group(2) else None
+                )
+                field = (keyword.split("[")[0], index)
+                self._append(field, _unquote(line[match.end() :]))
+            elif line.strip().startswith('"') and field is not None:
+                self._append(field, _unquote(line))
+
+    def _append(self, field: tuple[str, int | None], text: str) -> None:
+        keyword, index = field
+        if keyword == "msgctxt":
+            self.msgctxt += text
+        elif keyword == "msgid":
+            self.msgid += text
+        elif keyword == "msgid_plural":
+            self.msgid_plural = (self.msgid_plural or "") + text
+        else:
+            self.msgstr[index] = self.msgstr.get(index, "") + text
+
+    @property
+    def is_message(self) -> bool:
+        """Determine whether the entry is a translatable message."""
+        return not self.obsolete and self.msgid != "" and bool(self.msgstr)
+
+    @property
+    def translated(self) -> bool:
+        return not self.fuzzy and all(self.msgstr.values())
+
+    @property
+    def source(self) -> str:
+        """Fingerprint of the original text."""
+        return _fingerprint(self.msgctxt, self.msgid, self.msgid_plural or "")
+
+    @property
+    def translation(self) -> str:
+        """Fingerprint of the translated text."""
+        return _fingerprint(
+            *(self.msgstr[k] for k in sorted(self.msgstr, key=str))
+        )
+
+    def update(self, msgstr: dict[int | None, str]) -> None:
+        """Replace the translation, and drop the fuzzy flag."""
+        self.msgstr = msgstr
+        self.fuzzy = False
+
+        lines: list[str] = []
+        for line in self.lines:
+            if line.startswith("#|"):
+                # Previous msgid of a fuzzy entry
+                continue
+            if line.startswith("#,"):
+                flags = [f.strip() for f in line[2:].split(",")]
+                flags = [f for f in flags if f and f != "fuzzy"]
+                if flags:
+                    lines.append("#, " + ", ".join(flags))
+                continue
+            if line.startswith("msgstr"):
+                break
+            lines.append(line)
+
+        for index in sorted(msgstr, key=lambda i: -1 if i is None else i):
+            keyword: str = "msgstr" if index is None else f"msgstr[{index}]"
+            text: str = msgstr[index]
+            if "\n" in text.rstrip("\n"):
+                lines.append(f'{keyword} ""')
+                for part in text.splitlines(keepends=True):
+                    lines.append(_quote(part))
+            else:
+                lines.append(f"{keyword} {_quote(text)}")
+        self.lines = lines
+
+
+class Catalog:
+    def __init__(self, path: pathlib.Path):
+        """Gettext catalog that keeps its original formatting."""
+        self.path: pathlib.Path = path
+        self.entries: list[Entry] = []
+        # Lines between entries, kept as they are
+        self.separators: list[list[str]] = []
+
+        block: list[str] = []
+        gap: list[str] = []
+        for line in path.read_text().splitlines():
+            if line.strip() == "":
+                if block:
+                    self.separators.append(gap)
+                    self.entries.append(Entry(block))
+                    block, gap = [], []
+                gap.append(line)
+                continue
+            block.append(line)
+        if block:
+            self.separators.append(gap)
+            self.entries.append(Entry(block))
+            gap = []
+        self.trailer: list[str] = gap
+
+    @property
+    def language(self) -> str | None:
+        """Code of the language from the header, e.g. 'de' or 'pt_BR'."""
+        for entry in self.entries:
+            if entry.msgid == "" and entry.msgctxt == "" and not entry.obsolete:
+                match = _LANGUAGE.search(entry.msgstr.get(None, ""))
+                if match is None or not match.group(1):
+                    return None
+                return match.group(1)
+        return None
+
+    def write(self) -> None:
+        """Write the catalog back in place."""
+        lines: list[str] = []
+        for gap, entry in zip(self.separators, self.entries):
+            lines += gap
+            lines += entry.lines
+        lines += self.trailer
+
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text("\n".join(lines) + "\n")
+        tmp.replace(self.path)
+
+
+class State:
+    def __init__(self, catalog: pathlib.Path):
+        """Fingerprint index and checkpoint of a catalog.
+
+        The index maps translations made by sllm to the fingerprints of
+        their originals, so a changed msgid can be detected. The
+        checkpoint holds translations not yet written to the catalog.
+        """
+        key: str = _fingerprint(str(catalog.resolve()))
+        directory = sllm.common.cache_dir() / "po"
+        directory.mkdir(exist_ok=True)
+        self.index_path: pathlib.Path = directory / f"{key}.index.json"
+        self.checkpoint_path: pathlib.Path = directory / f"{key}.partial.json"
+
+        self.index: dict[str, list[str]] = self._load(self.index_path)
+        self.checkpoint: dict[str, list] = self._load(self.checkpoint_path)
+
+    @staticmethod
+    def _load(path: pathlib.Path) -> dict:
+        try:
+            content: dict = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return {}
+        return content
+
+    @staticmethod
+    def _save(path: pathlib.Path, content: dict) -> None:
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(json.dumps(content))
+        tmp.replace(path)
+
+    def outdated(self, entry: Entry) -> bool:
+        """Determine whether the entry needs to be translated."""
+        if not entry.translated:
+            return True
+        sources: list[str] | None = self.index.get(entry.translation)
+        return sources is not None and entry.source not in sources
+
+    def save_checkpoint(self) -> None:
+        self._save(self.checkpoint_path, self.checkpoint)
+
+    def commit(self, entries: list[Entry]) -> None:
+        """Record the translated entries and drop the checkpoint."""
+        for entry in entries:
+            sources = self.index.setdefault(entry.translation, [])
+            if entry.source not in sources:
+                sources.append(entry.source)
+        self._save(self.index_path, self.index)
+        self.checkpoint_path.unlink(missing_ok=True)
+
+
+def language_name(code: str) -> str:
+    """Describe the language to the model.
+
+    :param code: Code of the language, e.g. 'de', 'pt_BR' or 'sr@latin'.
+    """
+    base, _, modifier = code.partition("@")
+    language, _, region = base.replace("-", "_").partition("_")
+    name: str | None = LANGUAGES.get(language.lower())
+    if name is None:
+        return f"the language with the code '{code}'"
+    details: list[str] = [part for part in (region, modifier) if part]
+    if details:
+        name += f" ({', '.join(details)})"
+    return name
+
+
+def _keep_newlines(original: str, translation: str) -> str:
+    translation = translation.strip()
+    if original.startswith("\n"):
+        translation = "\n" + translation
+    if original.endswith("\n"):
+        translation += "\n"
+    return translation
+
+
+def translate(
+    path: pathlib.Path,
+    translate_text: Callable[[str, str], str],
+    *,
+    jobs: int,
+    batch: int = 16,
+) -> int:
+    """Translate outdated entries of a catalog in place.
+
+    Entries are translated into the language named by the 'Language:'
+    header of the catalog.
+
+    :param path: The catalog.
+    :param translate_text: Function translating a single text into the
+        language, as named by 'language_name()'.
+    :param jobs: How many texts to translate at the same time.
+    :param batch: How many entries to translate between checkpoints.
+    :returns: Number of translated entries.
+    :raises RuntimeError: The catalog does not name its language.
+    """
+    catalog = Catalog(path)
+    code: str | None = catalog.language
+    if code is None:
+        raise RuntimeError(
+            f"Catalog {path} does not name its language, "
+            "set the 'Language:' header."
+        )
+    language: str = language_name(code)
+    state = State(path)
+
+    todo: list[Entry] = [
+        e for e in catalog.entries if e.is_message and state.outdated(e)
+    ]
+    logger.info(f"{len(todo)} entries need to be translated into {language}.")
+
+    def work(entry: Entry) -> list:
+        singular: str = _keep_newlines(
+            entry.msgid, translate_text(entry.msgid, language)
+        )
+        if entry.msgid_plural is None:
+            return [[None, singular]]
+        plural: str = _keep_newlines(
+            entry.msgid_plural, translate_text(entry.msgid_plural, language)
+        )
+        return [[i, singular if i == 0 else plural] for i in entry.msgstr]
+
+    pending: list[Entry] = [e for e in todo if e.source not in state.checkpoint]
+    if len(pending) < len(todo):
+        logger.info(f"Resuming, {len(todo) - len(pending)} entries are done.")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        for start in range(0, len(pending), batch):
+            chunk: list[Entry] = pending[start : start + batch]
+            for entry, result in zip(chunk, pool.map(work, chunk)):
+                state.checkpoint[entry.source] = result
+            state.save_checkpoint()
+            logger.debug(f"Translated {start + len(chunk)}/{len(pending)}.")
+
+    for entry in todo:
+        entry.update(dict((k, v) for k, v in state.checkpoint[entry.source]))
+    catalog.write()
+    state.commit(todo)
+    return len(todo)
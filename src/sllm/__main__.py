@@ -0,0 +1,6 @@
+import sys
+
+import sllm.app
+
+
+sys.exit(sllm.app.main())
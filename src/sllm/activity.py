@@ -0,0 +1,120 @@
+import contextlib
+import itertools
+import logging
+import os
+import pathlib
+import threading
+import time
+from typing import Iterator
+
+import sllm.common
+
+
+ACTIVITY_FILE: str = "activity"
+INFLIGHT_DIR: str = "inflight"
+
+logger = logging.getLogger(__name__)
+
+_counter = itertools.count()
+
+
+def touch() -> None:
+    """Record that the server has just been used."""
+    path = sllm.common.runtime_dir() / ACTIVITY_FILE
+    try:
+        path.touch()
+    except OSError as exc:
+        logger.debug(f"Cannot record activity: {exc}.")
+
+
+@contextlib.contextmanager
+def request(instance: int = 0) -> Iterator[None]:
+    """Mark a request as being processed by the server.
+
+    The activity is recorded once the request completes.
+
+    :param instance: Server processing the request, see 'sllm.pool'.
+    """
+    directory = sllm.common.runtime_dir() / INFLIGHT_DIR
+    marker = directory / "{pid}-{thread}-{n}-{instance}".format(
+        pid=os.getpid(),
+        thread=threading.get_ident(),
+        n=next(_counter),
+        instance=instance,
+    )
+    try:
+        directory.mkdir(exist_ok=True)
+        marker.touch()
+    except OSError as exc:
+        logger.debug(f"Cannot mark request as in flight: {exc}.")
+
+    try:
+        yield
+    finally:
+        marker.unlink(missing_ok=True)
+        touch()
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def in_flight(instance: int | None = None) -> int:
+    """Count requests that are being processed.
+
+    Markers left behind by processes that no longer exist are removed.
+
+    :param instance: Only count requests processed by this server.
+    """
+    directory = sllm.common.runtime_dir() / INFLIGHT_DIR
+    if not directory.exists():
+        return 0
+
+    count: int = 0
+    for marker in directory.iterdir():
+        parts: list[str] = marker.name.split("-")
+        try:
+            pid = int(parts[0])
+        except ValueError:
+            continue
+        if instance is not None and parts[-1] != str(instance):
+            continue
+        if _alive(pid):
+            count += 1
+        else:
+            logger.debug(f"Removing stale marker of process {pid}.")
+            marker.unlink(missing_ok=True)
+    return count
+
+
+def last() -> float | None:
+    """Get the time of the last completed request.
+
+    :returns: UNIX timestamp, or None if the server was not used.
+    """
+    path: pathlib.Path = sllm.common.runtime_dir() / ACTIVITY_FILE
+    try:
+        return path.stat().st_mtime
+    except OSError:
+        return None
+
+
+def idle() -> float:
+    """Determine for how long the server has not been used.
+
+    :returns:
+        Seconds since the last request has completed, or 0 while some
+        requests are in flight.
+    """
+    if in_flight():
+        return 0.0
+    at: float | None = last()
+    if at is None:
+        return float("inf")
+    return max(time.time() - at, 0.0)
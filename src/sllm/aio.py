@@ -0,0 +1,314 @@
+import asyncio
+import contextlib
+import json
+import logging
+import time
+import urllib.parse
+import weakref
+from typing import AsyncIterator, Callable
+
+import sllm.api
+import sllm.client
+import sllm.common
+import sllm.pool
+import sllm.readiness
+
+
+logger = logging.getLogger(__name__)
+
+# Event loop -> semaphore
+_slots: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def slots() -> asyncio.Semaphore:
+    """Get the semaphore limiting requests sent from this event loop.
+
+    It allows as many requests as the servers process at the same time,
+    so that requests wait on the client, where they can be cancelled
+    cheaply, instead of in the server queue.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _slots:
+        _slots[loop] = asyncio.Semaphore(sllm.common.CAPACITY)
+    semaphore: asyncio.Semaphore = _slots[loop]
+    return semaphore
+
+
+async def ok(*, deep: bool = False) -> bool:
+    """Determine whether the model is able to respond.
+
+    See 'sllm.api.ok()'.
+    """
+    return await asyncio.to_thread(sllm.readiness.ready, deep=deep)
+
+
+class _Connection:
+    """Single HTTP/1.1 request to the API.
+
+    Closing the connection makes the server stop generating.
+    """
+
+    def __init__(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        self.reader = reader
+        self.writer = writer
+        self.netloc: str = ""
+        self.status: int = 0
+        self.chunked: bool = False
+        self.length: int | None = None
+
+    @classmethod
+    async def connect(cls, instance: int = 0) -> "_Connection":
+        """Connect to a server of the pool.
+
+        :raises ConnectionError: The server cannot be connected to.
+        """
+        url = urllib.parse.urlsplit(sllm.common.api_url(instance))
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(url.hostname, url.port),
+                sllm.client.CONNECT_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            raise ConnectionError(f"Connecting to {url.netloc} timed out.")
+        conn = cls(reader, writer)
+        conn.netloc = url.netloc
+        return conn
+
+    async def send(self, path: str, payload: dict) -> None:
+        """Send the request and read the headers of the response."""
+        reader, writer = self.reader, self.writer
+        body: bytes = json.dumps(payload, separators=(",", ":")).encode()
+        head: str = (
+            f"POST {path} HTTP/1.1\r\n"
+            f"Host: {self.netloc}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n"
+            "\r\n"
+        )
+        writer.write(head.encode() + body)
+        await writer.drain()
+
+        status_line: bytes = await reader.readline()
+        if not status_line:
+            raise ConnectionError("Server closed the connection.")
+        self.status = int(status_line.split()[1])
+        while True:
+            header: bytes = await reader.readline()
+            if header in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = header.decode("latin-1").partition(":")
+            name, value = name.strip().lower(), value.strip().lower()
+            if name == "transfer-encoding" and "chunked" in value:
+                self.chunked = True
+            if name == "content-length":
+                self.length = int(value)
+
+    async def _body(self) -> AsyncIterator[bytes]:
+        if not self.chunked:
+            if self.length is not None:
+                yield await self.reader.readexactly(self.length)
+                return
+            while data := await self.reader.read(2**16):
+                yield data
+            return
+
+        while True:
+            size_line: bytes = await self.reader.readline()
+            size: int = int(size_line.split(b";")[0].strip() or b"0", 16)
+            if size == 0:
+                return
+            yield await self.reader.readexactly(size)
+            await self.reader.readexactly(2)
+
+    async def lines(self) -> AsyncIterator[bytes]:
+        """Read the response body line by line."""
+        buffer: bytes = b""
+        async for data in self._body():
+            buffer += data
+            *complete, buffer = buffer.split(b"\n")
+            for line in complete:
+                if line.strip():
+                    yield line
+        if buffer.strip():
+            yield buffer
+
+    async def close(self) -> None:
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+
+class AsyncRequest(sllm.api.BaseRequest):
+    """Asynchronous counterpart of 'sllm.api.Request'."""
+
+    async def _ensure_ok(self) -> None:
+        if not await ok():
+            raise RuntimeError(
+                "Model is malfunctioning. Run again with '--debug', "
+                "or execute 'ramalama' yourself to investigate."
+            )
+
+    async def send(
+        self,
+        *,
+        timeout: float = 120,
+        callback: Callable[[str], None] | None = None,
+    ) -> str:
+        """Request an answer from the LLM.
+
+        :param timeout: Deadline for the whole request, in seconds.
+        :param callback:
+            If set, it is called with every chunk of text as soon as
+            it arrives.
+        :raises TimeoutError: Model works fine, but response timed out.
+        :raises RuntimeError: Model is malfunctioning.
+        """
+        chunks: list[str] = []
+        async for chunk in self.stream(timeout=timeout):
+            if callback is not None:
+                callback(chunk)
+            chunks.append(chunk)
+        return "".join(chunks).strip()
+
+    async def stream(self, *, timeout: float = 120) -> AsyncIterator[str]:
+        """Request an answer from the LLM, chunk by chunk.
+
+        Waits for a free slot on the server first. When the task is
+        cancelled or the deadline passes, the connection is closed, so
+        the server stops generating.
+
+        :param timeout: Deadline for the whole request, in seconds.
+        :raises TimeoutError: Model works fine, but response timed out.
+        :raises RuntimeError: Model is malfunctioning.
+        """
+        start: float = time.monotonic()
+        outcome: str = "error"
+        try:
+            async for chunk in self._stream(timeout=timeout):
+                yield chunk
+            outcome = "ok"
+        except TimeoutError:
+            outcome = "timeout"
+            raise
+        except (GeneratorExit, asyncio.CancelledError):
+            outcome = "cancelled"
+            raise
+        finally:
+            # Writes to the metrics database
+            await asyncio.to_thread(
+                self._record, outcome, time.monotonic() - start
+            )
+
+    async def _stream(self, *, timeout: float) -> AsyncIterator[str]:
+        cached: str | None = await asyncio.to_thread(self.cached)
+        if cached is not None:
+            yield cached
+            return
+
+        loop = asyncio.get_running_loop()
+        deadline: float = loop.time() + timeout
+
+        def remaining() -> float:
+            left: float = deadline - loop.time()
+            if left <= 0:
+                raise TimeoutError("Model didn't respond on time.")
+            return left
+
+        await self._ensure_ok()
+        async with slots():
+            # Closed in a thread, it removes the in-flight marker
+            stack = contextlib.ExitStack()
+            try:
+                logger.debug("Sending asynchronous API request.")
+                self._begin()
+                try:
+                    conn: _Connection = await self._connect(stack, remaining)
+                except asyncio.TimeoutError:
+                    raise TimeoutError("Model didn't respond on time.")
+
+                try:
+                    async for content in self._read(conn, remaining):
+                        yield content
+                finally:
+                    await conn.close()
+            finally:
+                await asyncio.to_thread(stack.close)
+
+        await asyncio.to_thread(self._finish)
+
+    async def _connect(
+        self, stack: contextlib.ExitStack, remaining: Callable[[], float]
+    ) -> _Connection:
+        """Send the request to the least loaded server.
+
+        Servers that cannot be connected to are skipped. Once the request
+        has been sent, it is never repeated; see 'sllm.pool.post()'.
+
+        :param stack: The request is in flight until the stack is closed.
+        :raises ConnectionError: No server accepted the connection.
+        """
+        payload: dict = self._build(stream=True)
+        tried: set[int] = set()
+        while True:
+            # The pool keeps its state in files, they are not touched
+            # in the event loop
+            attempt = contextlib.ExitStack()
+            instance: int = await asyncio.to_thread(
+                sllm.pool.reserve, attempt, exclude=tried
+            )
+            tried.add(instance)
+            try:
+                conn: _Connection = await asyncio.wait_for(
+                    _Connection.connect(instance), remaining()
+                )
+            except ConnectionError:
+                await asyncio.to_thread(attempt.close)
+                if len(tried) == sllm.common.INSTANCES:
+                    raise
+                await asyncio.to_thread(sllm.pool.mark_down, instance)
+                continue
+            except BaseException:
+                await asyncio.to_thread(attempt.close)
+                raise
+            if not await asyncio.to_thread(sllm.pool.healthy, instance):
+                await asyncio.to_thread(sllm.pool.mark_up, instance)
+            stack.enter_context(attempt)
+            break
+
+        try:
+            await asyncio.wait_for(conn.send("/api/chat", payload), remaining())
+        except BaseException:
+            await conn.close()
+            raise
+        return conn
+
+    async def _read(
+        self, conn: _Connection, remaining: Callable[[], float]
+    ) -> AsyncIterator[str]:
+        if conn.status != 200:
+            body: bytes = b"".join([line async for line in conn.lines()])
+            raise RuntimeError(
+                f"Server responded with {conn.status}: "
+                f"{body.decode(errors='replace')}"
+            )
+
+        lines = conn.lines()
+        while self.stats is None:
+            try:
+                line: bytes = await asyncio.wait_for(
+                    lines.__anext__(), remaining()
+                )
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                logger.debug("Model timed out.")
+                raise TimeoutError("Model didn't respond on time.")
+
+            content: str = self._feed(line)
+            if content:
+                yield content
@@ -1,57 +1,87 @@
+import dataclasses
+import json
 import logging
+import sqlite3
+import time
+from typing import Callable, Generator, Iterator
 
-import requests
-
+import sllm.broker
+import sllm.cache
 import sllm.common
+import sllm.metrics
+import sllm.pool
+import sllm.readiness
+import sllm.trace
+import sllm.tuning
+
 
+# Room for the chat template around the messages, in tokens
+TEMPLATE_TOKENS: int = 32
 
 logger = logging.getLogger(__name__)
 
 
-def ok() -> bool:
-    """Send a healthcheck.
+def ok(*, deep: bool = False) -> bool:
+    """Determine whether the model is able to respond.
 
-    Models can go crazy when their runtime misconfigures them.
-    This should be good enough indicator to determine whether the
-    model is good or not.
+    The model itself is only asked a question when the server or the
+    model changed since the last successful check; see
+    'sllm.readiness.ready()'.
 
+    :param deep: Always ask the model a question.
     :returns: True if the model is able to respond.
     """
-    logger.debug("Sending health/sanity check request.")
-
-    try:
-        req: requests.Response = requests.post(
-            f"{sllm.common.API_URL}/api/chat",
-            json={
-                "model": sllm.common.MODEL,
-                "temperature": 0.0,
-                "stream": False,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": "Reply with the string 'pong'.",
-                    }
-                ],
-            },
-            timeout=(0.5, 5),
-        )
-    except requests.exceptions.Timeout:
-        logger.error("Model didn't respond on time.")
-        return False
-
-    response: dict = req.json()
-    pong: str = response["message"]["content"].strip()
-    if pong != "pong":
-        logger.error(
-            f"Model didn't respond properly: wanted 'pong', got '{pong}'."
-        )
-        return False
+    return sllm.readiness.ready(deep=deep)
 
-    logger.debug("Model seems to be sane and healthy.")
-    return True
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens in a text.
+
+    The estimate is pessimistic: English averages about four bytes per
+    token, other languages are less efficient.
+    """
+    return len(text.encode()) // 3 + 1
 
 
-class Request:
+@dataclasses.dataclass
+class Stats:
+    """Timing information of a finished request.
+
+    Durations reported by the server are in nanoseconds, client-side
+    measurements are in seconds.
+    """
+
+    total_duration: int = 0
+    load_duration: int = 0
+    prompt_eval_count: int = 0
+    prompt_eval_duration: int = 0
+    eval_count: int = 0
+    eval_duration: int = 0
+    time_to_first_token: float | None = None
+    wall_time: float = 0.0
+    done_reason: str = ""
+
+    @classmethod
+    def from_response(cls, response: dict, **kwargs: float | None) -> "Stats":
+        """Load the statistics from the final API response.
+
+        :param response: The last (or only) JSON object sent by the server.
+        :param kwargs: Client-side measurements.
+        """
+        fields = {f.name for f in dataclasses.fields(cls)}
+        values: dict = {k: v for k, v in response.items() if k in fields}
+        values.update(kwargs)
+        return cls(**values)
+
+    @property
+    def tokens_per_second(self) -> float:
+        """Generation speed, as reported by the server."""
+        if not self.eval_duration:
+            return 0.0
+        return self.eval_count / (self.eval_duration / 10**9)
+
+
+class BaseRequest:
     def __init__(
         self,
         prompt: str = "You are a helpful assistant.",
@@ -60,6 +90,13 @@ class Request:
         example_input_header: str = "",
         example_response_header: str = "",
         temperature: float = 0.8,
+        max_tokens: int = 1024,
+        stop: list[str] | None = None,
+        cache: bool = False,
+        keep_alive: int | None = None,
+        priority: int = sllm.broker.PRIORITY_INTERACTIVE,
+        prefix_cache: bool = False,
+        record: bool = True,
     ):
         """Build an API request.
 
@@ -74,60 +111,456 @@ class Request:
         :param temperature:
             Model temperature. Conservative between 0.6 and 1.0,
             creative between 1.0 and 2.0.
+        :param max_tokens:
+            Maximal length of the response, in tokens. The model is
+            stopped once it reaches it.
+        :param stop:
+            Strings that end the response, e.g. the header of the next
+            example the model would otherwise make up.
+        :param cache:
+            Reuse the response to an identical request made earlier,
+            and store the response for later.
+        :param keep_alive:
+            How long the model stays in memory after the request,
+            in seconds. Defaults to 'SLLM_KEEP_ALIVE', see
+            'sllm.common.keep_alive()'.
+        :param priority:
+            Priority of the request in the broker queue, see
+            'sllm.broker'. Lower numbers are served first.
+        :param prefix_cache:
+            Lay the request out so that the server can reuse the
+            evaluated system prompt of earlier requests; see
+            'prefix_tokens()'.
+        :param record:
+            Add the request to the statistics, see 'sllm.metrics'.
         """
         self.prompt: str = prompt
         self.query: str = query
         self.temperature: float = temperature
+        self.max_tokens: int = max_tokens
+        self.stop: list[str] = stop or []
         self.example_input_header: str = example_input_header
         self.example_response_header: str = example_response_header
+        self.cache: bool = cache
+        self.keep_alive: int = (
+            sllm.common.keep_alive() if keep_alive is None else keep_alive
+        )
+        self.priority: int = priority
+        self.prefix_cache: bool = prefix_cache
+        self.record: bool = record
+        self._cache_missed: bool = False
+        self._cache_hit: str | None = None
+        self.stats: Stats | None = None
+        self._start: float = 0.0
+        self._first: float | None = None
+        self._chunks: list[str] = []
+
+    def prefix_tokens(self) -> int:
+        """Estimate the size of the part shared by all requests.
+
+        The system prompt and the input header are the same for every
+        query. The server keeps them evaluated between requests, as long
+        as they are byte-for-byte identical and nothing else is evaluated
+        in between. Only the query, which comes last, is new.
+
+        :returns: Size of the shared prefix, in tokens.
+        """
+        return estimate_tokens(self.prompt + self.example_input_header)
+
+    def _user_message(self) -> str:
+        return "{}\n{}\n{}".format(
+            self.example_input_header,
+            self.query,
+            self.example_response_header,
+        )
+
+    def context_size(self) -> int:
+        """Size the context window to fit the request and the response.
+
+        The size is 'SLLM_CONTEXT' doubled as many times as needed. The
+        server reloads the model whenever the size changes, so most
+        requests should fit into the same one.
 
-    def _build(self) -> dict:
+        :returns: Size of the context window, in tokens.
+        :raises ValueError: The request does not fit into 'SLLM_MAX_CONTEXT'.
+        """
+        needed: int = (
+            estimate_tokens(self.prompt)
+            + estimate_tokens(self._user_message())
+            + TEMPLATE_TOKENS
+            + self.max_tokens
+        )
+        if needed > sllm.common.MAX_CONTEXT:
+            raise ValueError(
+                f"Input is too long: the request and its response need "
+                f"about {needed} tokens, at most "
+                f"{sllm.common.MAX_CONTEXT} are allowed."
+            )
+        size: int = sllm.common.CONTEXT
+        while size < needed:
+            size *= 2
+        return min(size, sllm.common.MAX_CONTEXT)
+
+    def _build(self, *, stream: bool = False) -> dict:
+        options: dict = {
+            "temperature": self.temperature,
+            "num_ctx": self.context_size(),
+            "num_predict": self.max_tokens,
+            **sllm.tuning.options(),
+        }
+        if self.stop:
+            options["stop"] = self.stop
+        if self.prefix_cache:
+            # Keep the prefix when the context overflows and is shifted
+            options["num_keep"] = self.prefix_tokens()
         return {
             "model": sllm.common.MODEL,
-            "temperature": self.temperature,
-            "stream": False,
+            "stream": stream,
+            "keep_alive": self.keep_alive,
+            "options": options,
             "messages": [
                 {"role": "system", "content": self.prompt},
-                {
-                    "role": "user",
-                    "content": "{}\n{}\n{}".format(
-                        self.example_input_header,
-                        self.query,
-                        self.example_response_header,
-                    ),
-                },
+                {"role": "user", "content": self._user_message()},
             ],
         }
 
-    def send(self, *, timeout: int = 120) -> str:
+    def cached(self) -> str | None:
+        """Look up the response in the cache.
+
+        This does not contact the server, the model digest known from
+        the last request is used. The result is remembered, repeated
+        calls do not read the cache again.
+
+        :returns: The response, if caching is enabled and it is cached.
+        """
+        if not self.cache or self._cache_missed:
+            return None
+        if self._cache_hit is not None:
+            return self._cache_hit
+
+        try:
+            cache = sllm.cache.Cache()
+            try:
+                digest: str | None = cache.digest(sllm.common.MODEL)
+                if digest is None:
+                    return None
+                key: str = sllm.cache.key(digest, self._build())
+                with sllm.trace.span("cache"):
+                    response: str | None = cache.get(key)
+            finally:
+                cache.close()
+        except sqlite3.Error as exc:
+            logger.warning(f"Cannot read the response cache: {exc}.")
+            return None
+
+        if response is None:
+            self._cache_missed = True
+        else:
+            self._cache_hit = response
+            logger.debug("Response has been found in the cache.")
+        return response
+
+    def _store(self, response: str) -> None:
+        if not self.cache:
+            return
+
+        state: dict | None = sllm.readiness.load_state()
+        if state is None or state.get("model") != sllm.common.MODEL:
+            logger.debug("Model digest is not known, not caching.")
+            return
+
+        try:
+            cache = sllm.cache.Cache()
+            try:
+                cache.set_digest(sllm.common.MODEL, state["digest"])
+                key: str = sllm.cache.key(state["digest"], self._build())
+                cache.put(key, response)
+            finally:
+                cache.close()
+        except sqlite3.Error as exc:
+            logger.warning(f"Cannot write the response cache: {exc}.")
+
+    def _begin(self) -> None:
+        self.stats = None
+        self._start = time.monotonic()
+        self._first = None
+        self._chunks = []
+
+    def _feed(self, line: bytes) -> str:
+        """Process one line of the streamed response.
+
+        Once the final line is processed, 'stats' are set.
+
+        :returns: Text for the caller, possibly empty.
+        :raises RuntimeError: Model is malfunctioning.
+        """
+        chunk: dict = json.loads(line)
+        if "error" in chunk:
+            raise RuntimeError(f"Model returned an error: {chunk['error']}")
+
+        content: str = chunk.get("message", {}).get("content", "")
+        if self._first is None:
+            # Models like to start with an empty line
+            content = content.lstrip()
+        if content:
+            if self._first is None:
+                self._first = time.monotonic() - self._start
+            self._chunks.append(content)
+
+        if chunk.get("done", False):
+            self.stats = Stats.from_response(
+                chunk,
+                time_to_first_token=self._first,
+                wall_time=time.monotonic() - self._start,
+            )
+        return content
+
+    def _finish(self) -> None:
+        """Wrap up the streamed response.
+
+        :raises RuntimeError: The stream ended before the model finished.
+        """
+        if self.stats is None:
+            raise RuntimeError("Model did not finish the response.")
+
+        self._store("".join(self._chunks).strip())
+        logger.debug(
+            "Streamed {tokens} tokens ({tps:.1f} tokens/s, "
+            "first token after {ttft:.2f} s).".format(
+                tokens=self.stats.eval_count,
+                tps=self.stats.tokens_per_second,
+                ttft=self.stats.time_to_first_token or 0.0,
+            )
+        )
+        self._log_prompt_eval()
+        self._check_length()
+        self._trace_phases()
+
+    def _record(self, outcome: str, wall_time: float) -> None:
+        """Add the request to the persistent statistics.
+
+        :param outcome: 'ok', 'timeout', 'cancelled' or 'error'.
+        :param wall_time: How long the caller waited, in seconds.
+        """
+        if not self.record:
+            return
+        stats: Stats = self.stats or Stats()
+        if self._cache_hit is not None:
+            cache: str = "hit"
+        elif self.cache:
+            cache = "miss"
+        else:
+            cache = "off"
+        sllm.metrics.record(
+            {
+                "input_tokens": stats.prompt_eval_count,
+                "output_tokens": stats.eval_count,
+                # Waiting in queues and the network, unknown to the server
+                "queue": max(wall_time - stats.total_duration / 10**9, 0.0)
+                if self.stats is not None
+                else 0.0,
+                "load": stats.load_duration / 10**9,
+                "prompt_eval": stats.prompt_eval_duration / 10**9,
+                "eval": stats.eval_duration / 10**9,
+                "wall_time": wall_time,
+                "time_to_first_token": stats.time_to_first_token,
+                "cache": cache,
+                "outcome": outcome,
+            }
+        )
+
+    def _trace_phases(self) -> None:
+        """Record the phases measured by the server as spans."""
+        if self.stats is None:
+            return
+        phases: list[tuple[str, int]] = [
+            ("load", self.stats.load_duration),
+            ("prompt_eval", self.stats.prompt_eval_duration),
+            ("eval", self.stats.eval_duration),
+        ]
+        # The phases have just finished, one after another
+        start: float = time.time() - sum(d for _, d in phases) / 10**9
+        for name, duration in phases:
+            sllm.trace.record(name, duration / 10**9, start=start)
+            start += duration / 10**9
+
+    def _log_prompt_eval(self) -> None:
+        """Report how much of the prompt the server had to evaluate.
+
+        When the prefix is reused, only the query is evaluated, and the
+        count is lower than the size of the prefix.
+        """
+        if self.stats is None:
+            return
+        logger.debug(
+            "Evaluated {count} prompt tokens in {duration:.2f} s "
+            "(shared prefix is about {prefix} tokens).".format(
+                count=self.stats.prompt_eval_count,
+                duration=self.stats.prompt_eval_duration / 10**9,
+                prefix=self.prefix_tokens(),
+            )
+        )
+
+    def _check_length(self) -> None:
+        if self.stats is not None and self.stats.done_reason == "length":
+            logger.warning(
+                f"Response has been cut after {self.max_tokens} tokens."
+            )
+
+
+class Request(BaseRequest):
+    def _ensure_ok(self) -> None:
+        if not ok():
+            raise RuntimeError(
+                "Model is malfunctioning. Run again with '--debug', "
+                "or execute 'ramalama' yourself to investigate."
+            )
+
+    def send(
+        self,
+        *,
+        timeout: int = 120,
+        callback: Callable[[str], None] | None = None,
+    ) -> str:
         """Request an answer from the LLM.
 
         Expects ramalama to be serving OpenAPI-compatible API on
         localhost on a well-known port.
 
         :param timeout: REST call timeout, in seconds.
+        :param callback:
+            If set, the response is streamed and the callback is called
+            with every chunk of text as soon as it arrives.
         :raises TimeoutError: Model works fine, but response timed out.
         :raises RuntimeError: Model is malfunctioning.
         """
+        start: float = time.monotonic()
+        outcome: str = "error"
+        try:
+            response: str = self._send(timeout=timeout, callback=callback)
+            outcome = "ok"
+            return response
+        except TimeoutError:
+            outcome = "timeout"
+            raise
+        finally:
+            self._record(outcome, time.monotonic() - start)
+
+    def _send(
+        self, *, timeout: int, callback: Callable[[str], None] | None
+    ) -> str:
+        cached: str | None = self.cached()
+        if cached is not None:
+            if callback is not None:
+                callback(cached)
+            return cached
+
+        import requests
+
+        if callback is not None or sllm.broker.available():
+            chunks: list[str] = []
+            for chunk in self._stream(timeout=timeout):
+                if callback is not None:
+                    callback(chunk)
+                chunks.append(chunk)
+            return "".join(chunks).strip()
+
         logger.debug("Sending API request.")
+        self._ensure_ok()
 
-        if not ok():
-            raise RuntimeError(
-                "Model is malfunctioning. "
-                "Run again with '--debug', or execute 'ramalama' yourself to investigate."
+        self.stats = None
+        start: float = time.monotonic()
+        with sllm.trace.span("request"):
+            try:
+                with sllm.pool.post(
+                    "/api/chat", self._build(), timeout=timeout
+                ) as req:
+                    response: dict = req.json()
+            except requests.exceptions.Timeout:
+                logger.debug("Model timed out.")
+                raise TimeoutError("Model didn't respond on time.")
+
+            if "error" in response:
+                raise RuntimeError(
+                    f"Model returned an error: {response['error']}"
+                )
+            if not response.get("done", False):
+                raise RuntimeError("Model did not finish the response.")
+            self.stats = Stats.from_response(
+                response, wall_time=time.monotonic() - start
             )
+            content: str = response["message"]["content"].strip()
+            self._store(content)
+            self._log_prompt_eval()
+            self._check_length()
+            self._trace_phases()
+        return content
 
+    def _lines(self, timeout: int) -> Generator[bytes, None, None]:
+        broker = sllm.broker.connect(timeout=timeout)
+        if broker is not None:
+            logger.debug("Sending streaming request through the broker.")
+            with broker:
+                broker.send(self._build(stream=True), priority=self.priority)
+                yield from broker.lines()
+            return
+
+        logger.debug("Sending streaming API request.")
+        self._ensure_ok()
+        with sllm.pool.post(
+            "/api/chat", self._build(stream=True), stream=True, timeout=timeout
+        ) as req:
+            for line in req.iter_lines():
+                if line:
+                    yield line
+
+    def stream(self, *, timeout: int = 120) -> Iterator[str]:
+        """Request an answer from the LLM, chunk by chunk.
+
+        If the broker ('sllm serve') is running, the request is sent
+        through it. Once the iterator is exhausted, timing information
+        is available in the 'stats' attribute.
+
+        :param timeout: Timeout between two chunks, in seconds.
+        :raises TimeoutError: Model works fine, but response timed out.
+        :raises RuntimeError: Model is malfunctioning.
+        """
+        start: float = time.monotonic()
+        outcome: str = "error"
         try:
-            req: requests.Response = requests.post(
-                f"{sllm.common.API_URL}/api/chat",
-                json=self._build(),
-                # connection timeout can be very low, we're on localhost
-                timeout=(0.5, timeout),
-            )
-        except requests.exceptions.Timeout:
-            logger.debug("Model timed out.")
-            raise TimeoutError("Model didn't respond on time.")
+            yield from self._stream(timeout=timeout)
+            outcome = "ok"
+        except TimeoutError:
+            outcome = "timeout"
+            raise
+        except GeneratorExit:
+            outcome = "cancelled"
+            raise
+        finally:
+            self._record(outcome, time.monotonic() - start)
 
-        response: dict = req.json()
-        content: str = response["message"]["content"].strip()
-        return content
+    def _stream(self, *, timeout: int) -> Iterator[str]:
+        cached: str | None = self.cached()
+        if cached is not None:
+            yield cached
+            return
+
+        import requests
+
+        with sllm.trace.span("request"):
+            self._begin()
+            lines: Generator[bytes, None, None] = self._lines(timeout)
+            try:
+                for line in lines:
+                    content: str = self._feed(line)
+                    if content:
+                        yield content
+                    if self.stats is not None:
+                        break
+            except (requests.exceptions.Timeout, TimeoutError):
+                logger.debug("Model timed out.")
+                raise TimeoutError("Model didn't respond on time.")
+            finally:
+                lines.close()
+
+            self._finish()
@@ -1,119 +1,420 @@
 import argparse
+import concurrent.futures
 import datetime
 import json
+import pathlib
 import subprocess
 import sys
+import time
 import logging
 import traceback
+from typing import Callable
 
-import requests
-
+import sllm.activity
+import sllm.broker
+import sllm.cache
 import sllm.common
 import sllm.container
+import sllm.metrics
+import sllm.pool
+import sllm.readiness
+import sllm.tuning
 
 
 logger = logging.getLogger(__name__)
 
 
-def _status_runtime() -> None:
+# Deadline of a single status probe, in seconds
+STATUS_TIMEOUT: float = 3.0
+
+
+def _when(timestamp: float) -> str:
+    at = datetime.datetime.fromtimestamp(timestamp)
+    return at.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _status_runtime() -> dict:
     # Check if this image is present in podman
     query_cmd = ["podman", "image", "ls", "--format", "json"]
-    proc = subprocess.run(query_cmd, text=True, capture_output=True)
+    proc = subprocess.run(
+        query_cmd, text=True, capture_output=True, timeout=STATUS_TIMEOUT
+    )
     if proc.returncode > 0:
-        logger.error(f"Cannot query for runtime: {proc.stderr.strip()}")
-        return
+        return {
+            "error": proc.stderr.strip(),
+            "message": f"Cannot query for runtime: {proc.stderr.strip()}",
+        }
 
     images: list[dict] = json.loads(proc.stdout)
     for image in images:
         if sllm.container.IMAGE in image.get("Names", []):
             break
     else:
-        logger.info("Runtime is not present.")
-        return
+        return {"present": False, "message": "Runtime is not present."}
 
-    logger.info(
-        "Runtime is present ({size:.2f} GB).".format(
+    return {
+        "present": True,
+        "size": image["Size"],
+        "message": "Runtime is present ({size:.2f} GB).".format(
             size=image["Size"] / 2**30,
-        )
-    )
+        ),
+    }
+
 
+def _status_model() -> dict:
+    import sllm.client
 
-def _status_model() -> None:
     try:
-        resp = requests.get(f"{sllm.common.API_URL}/api/tags")
+        resp = sllm.client.shared().get("/api/tags", timeout=STATUS_TIMEOUT)
     except Exception as exc:
-        logger.info("HTTP API is not running, models not accessible.")
         logger.debug(f"HTTP API is not running: {exc}.")
-        return
+        return {
+            "present": None,
+            "message": "HTTP API is not running, models not accessible.",
+        }
 
     if not resp.ok:
-        logger.info("HTTP API is not running, models not accessible.")
         logger.debug(f"HTTP API is not well: {resp}.")
-        return
+        return {
+            "present": None,
+            "message": "HTTP API is not running, models not accessible.",
+        }
 
-    for model in resp.json().get("models"):
-        if sllm.common.MODEL in model["name"]:
-            break
-    else:
-        logger.info("Model is not present.")
-        return
+    model: dict | None = sllm.readiness.find_model(
+        resp.json().get("models") or []
+    )
+    if model is None:
+        return {"present": False, "message": "Model is not present."}
 
-    logger.info(
-        "Model is present ({quant}, {size:.2f} GB).".format(
+    return {
+        "present": True,
+        "name": model["name"],
+        "digest": model.get("digest", ""),
+        "quantization": model["details"]["quantization_level"],
+        "size": model["size"],
+        "message": "Model is present ({quant}, {size:.2f} GB).".format(
             quant=model["details"]["quantization_level"],
             size=model["size"] / 2**30,
+        ),
+    }
+
+
+def _status_loaded() -> dict:
+    import sllm.client
+
+    try:
+        resp = sllm.client.shared().get("/api/ps", timeout=STATUS_TIMEOUT)
+        models: list[dict] = resp.json().get("models") or []
+    except Exception as exc:
+        logger.debug(f"Cannot list loaded models: {exc}.")
+        return {"models": [], "message": "Loaded models are not known."}
+
+    loaded: list[dict] = [
+        {
+            "name": model["name"],
+            "size": model.get("size", 0),
+            "size_vram": model.get("size_vram", 0),
+            "expires_at": model.get("expires_at", ""),
+        }
+        for model in models
+    ]
+    if not loaded:
+        return {"models": [], "message": "No model is loaded in memory."}
+
+    message: str = " ".join(
+        "Model {name} is loaded ({vram:.2f} GB VRAM, {ram:.2f} GB RAM, "
+        "until {until}).".format(
+            name=model["name"],
+            vram=model["size_vram"] / 2**30,
+            ram=(model["size"] - model["size_vram"]) / 2**30,
+            until=model["expires_at"][:19].replace("T", " "),
         )
+        for model in loaded
     )
+    return {"models": loaded, "message": message}
+
 
+def _status_api() -> dict:
+    import sllm.client
 
-def _status_api() -> None:
     try:
-        resp = requests.get(f"{sllm.common.API_URL}/api/version")
+        resp = sllm.client.shared().get("/api/version", timeout=STATUS_TIMEOUT)
     except Exception as exc:
-        logger.info("HTTP API is not running.")
         logger.debug(f"HTTP API is not running: {exc}.")
-        return
+        return {"running": False, "message": "HTTP API is not running."}
 
     if not resp.ok:
-        logger.info("HTTP API is not running.")
         logger.debug(f"HTTP API is not well: {resp}.")
-        return
+        return {"running": False, "message": "HTTP API is not running."}
 
     version: str = resp.json().get("version", "unknown")
-    logger.info(
-        f"API is present (http://127.0.0.1:{sllm.common.API_PORT}, "
-        f"version {version})."
-    )
+    return {
+        "running": True,
+        "url": f"http://127.0.0.1:{sllm.common.API_PORT}",
+        "version": version,
+        "message": (
+            f"API is present (http://127.0.0.1:{sllm.common.API_PORT}, "
+            f"version {version})."
+        ),
+    }
+
 
+def _status_pool() -> dict:
+    servers: list[dict] = [
+        {
+            "url": sllm.common.api_url(instance),
+            "running": sllm.container.responding(instance),
+            "in_flight": sllm.activity.in_flight(instance),
+        }
+        for instance in sllm.pool.instances()
+    ]
+    running: int = sum(server["running"] for server in servers)
+    return {
+        "servers": servers,
+        "message": "Pool has {running} of {total} servers running: "
+        "{servers}.".format(
+            running=running,
+            total=len(servers),
+            servers=", ".join(
+                "{port} {state}, {n} in flight".format(
+                    port=server["url"].rsplit(":", 1)[-1],
+                    state="up" if server["running"] else "down",
+                    n=server["in_flight"],
+                )
+                for server in servers
+            ),
+        ),
+    }
 
-def _status_shutdown() -> None:
+
+def _status_shutdown() -> dict:
     cmd = ["systemctl", "--user", "list-timers", "--output", "json"]
-    proc = subprocess.run(cmd, text=True, capture_output=True)
+    proc = subprocess.run(
+        cmd, text=True, capture_output=True, timeout=STATUS_TIMEOUT
+    )
     if proc.returncode > 0:
-        logger.error(f"Cannot query for timers: {proc.stderr.strip()}")
-        return
+        return {
+            "error": proc.stderr.strip(),
+            "message": f"Cannot query for timers: {proc.stderr.strip()}",
+        }
 
     timers: list[dict] = json.loads(proc.stdout)
     for timer in timers:
         if timer["unit"] == f"{sllm.container.SHUTDOWN_NAME}.timer":
             break
     else:
-        logger.info("Container shutdown is not scheduled.")
+        return {
+            "scheduled": False,
+            "message": "Container shutdown is not scheduled.",
+        }
+
+    if in_flight := sllm.activity.in_flight():
+        return {
+            "scheduled": True,
+            "in_flight": in_flight,
+            "message": f"Container is processing {in_flight} requests.",
+        }
+
+    last: float = sllm.activity.last() or timer["next"] / 10**6
+    at: float = last + sllm.common.shutdown_interval()
+    return {
+        "scheduled": True,
+        "in_flight": 0,
+        "at": at,
+        "message": f"Container shutdown is scheduled when idle ({_when(at)}).",
+    }
+
+
+def _status_ready(deep: bool) -> dict:
+    if deep:
+        sane: bool = sllm.readiness.ready(deep=True)
+        return {
+            "sane": sane,
+            "message": "Model responds sanely."
+            if sane
+            else "Model does not respond sanely.",
+        }
+
+    state: dict | None = sllm.readiness.load_state()
+    if state is None or state.get("model") != sllm.common.MODEL:
+        return {
+            "verified": None,
+            "message": "Model has not been verified yet.",
+        }
+
+    return {
+        "verified": state["timestamp"],
+        "message": f"Model has been verified ({_when(state['timestamp'])}).",
+    }
+
+
+def _status_tuning() -> dict:
+    profile: sllm.tuning.Profile = sllm.tuning.profile()
+    host: sllm.tuning.Host = profile.host
+    settings: list[str] = [
+        f"{name}={value}" + (" (set)" if name in profile.overridden else "")
+        for name, value in profile.settings.items()
+        if value
+    ]
+    return {
+        "cpus": len(host.cpus),
+        "nodes": len(host.nodes),
+        "memory": host.memory,
+        "settings": profile.settings,
+        "overridden": profile.overridden,
+        "config": str(profile.config),
+        "message": "Tuned for {cpus} CPUs, {nodes} NUMA {noun}, {memory:.1f} "
+        "GB: {settings}.".format(
+            cpus=len(host.cpus),
+            nodes=len(host.nodes),
+            noun="node" if len(host.nodes) == 1 else "nodes",
+            memory=host.memory / 2**30,
+            settings=", ".join(settings),
+        ),
+    }
+
+
+def collect_status(*, deep: bool = False, cheap: bool = False) -> dict:
+    """Run the status probes concurrently.
+
+    Every probe has its own deadline, so a stuck container or podman
+    cannot block the others.
+
+    :param deep: Query the model.
+    :param cheap: Skip probes listing images and downloaded models.
+    :returns: Results of the probes, by their name.
+    """
+    probes: dict[str, tuple[Callable[[], dict], float]] = {
+        "runtime": (_status_runtime, STATUS_TIMEOUT),
+        "api": (_status_api, STATUS_TIMEOUT),
+        "model": (_status_model, STATUS_TIMEOUT),
+        "loaded": (_status_loaded, STATUS_TIMEOUT),
+        # The canary takes longer
+        "ready": (lambda: _status_ready(deep), 4 * STATUS_TIMEOUT),
+        "shutdown": (_status_shutdown, STATUS_TIMEOUT),
+        "tuning": (_status_tuning, STATUS_TIMEOUT),
+    }
+    if sllm.common.INSTANCES > 1:
+        probes["pool"] = (_status_pool, STATUS_TIMEOUT)
+    if cheap:
+        del probes["runtime"]
+        del probes["model"]
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(probes))
+    futures = {name: pool.submit(probe) for name, (probe, _) in probes.items()}
+    results: dict[str, dict] = {}
+    deadline: float = time.monotonic()
+    for name, future in futures.items():
+        limit: float = deadline + probes[name][1] - time.monotonic()
+        try:
+            results[name] = future.result(timeout=max(limit, 0))
+        except (concurrent.futures.TimeoutError, subprocess.TimeoutExpired):
+            results[name] = {
+                "error": "timeout",
+                "message": f"Probe '{name}' did not finish on time.",
+            }
+        except Exception as exc:
+            logger.debug(f"Probe '{name}' failed: {exc}.")
+            results[name] = {
+                "error": str(exc),
+                "message": f"Probe '{name}' failed: {exc}",
+            }
+    # Do not wait for probes that are stuck
+    pool.shutdown(wait=False, cancel_futures=True)
+    return results
+
+
+def status(
+    deep: bool = False, *, as_json: bool = False, watch: float | None = None
+) -> None:
+    if watch is None:
+        results: dict[str, dict] = collect_status(deep=deep)
+        if as_json:
+            print(json.dumps(results, indent=2))
+            return
+        for result in results.values():
+            logger.info(result["message"])
         return
 
-    at = datetime.datetime.fromtimestamp(timer["next"] // 10**6)
-    logger.info(
-        "Container shutdown is scheduled ({ts}).".format(
-            ts=at.strftime("%Y-%m-%d %H:%M:%S"),
+    results = collect_status(deep=deep)
+    try:
+        while True:
+            if as_json:
+                print(
+                    json.dumps({"timestamp": time.time(), **results}),
+                    flush=True,
+                )
+            else:
+                if sys.stdout.isatty():
+                    # Clear the screen
+                    print("\033[H\033[2J", end="", flush=True)
+                print(f"{_when(time.time())}, every {watch:g} s")
+                for result in results.values():
+                    print(result["message"], flush=True)
+            time.sleep(watch)
+            # Images and downloaded models rarely change
+            results.update(collect_status(cheap=True))
+    except KeyboardInterrupt:
+        pass
+
+
+def cache(action: str) -> None:
+    store = sllm.cache.Cache()
+    try:
+        if action == "clear":
+            store.clear()
+            logger.info("Cache has been cleared.")
+            return
+
+        stats: dict = store.stats()
+        logger.info(
+            "Cache holds {n} responses ({size:.2f} of {max:.2f} MB).".format(
+                n=stats["entries"],
+                size=stats["size"] / 2**20,
+                max=stats["max_size"] / 2**20,
+            )
+        )
+        logger.info(
+            f"Cache has been hit {stats['hits']} times "
+            f"and missed {stats['misses']} times."
         )
+    finally:
+        store.close()
+
+
+def bench(
+    *, iterations: int, concurrency: list[int], cold: bool, as_json: bool
+) -> None:
+    # Imported here, it pulls in the whole client
+    import sllm.bench
+
+    report: dict = sllm.bench.benchmark(
+        iterations=iterations, concurrency=concurrency, cold=cold
     )
+    if as_json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(sllm.bench.format_report(report))
+
 
+def stats(since: str, *, as_json: bool, textfile: pathlib.Path | None) -> None:
+    window: float = sllm.common.parse_interval(since)
+    store = sllm.metrics.Store()
+    try:
+        rows: list[dict] = store.rows(time.time() - window)
+    finally:
+        store.close()
 
-def status() -> None:
-    _status_runtime()
-    _status_api()
-    _status_model()
-    _status_shutdown()
+    summary: dict = sllm.metrics.summarize(rows, window)
+    if textfile is not None:
+        sllm.metrics.write_textfile(textfile, summary)
+        logger.debug(f"Metrics have been written to {textfile}.")
+    if as_json:
+        print(json.dumps(summary, indent=2))
+    elif textfile is None:
+        logger.info(f"Requests in the last {since}:")
+        for line in sllm.metrics.format_summary(summary):
+            logger.info(line)
 
 
 def app() -> None:
@@ -123,25 +424,150 @@ def app() -> None:
     flags.add_argument("--status", action="store_true", help="runtime status")
     flags.add_argument("--start", action="store_true", help="start the runtime")
     flags.add_argument("--stop", action="store_true", help="stop the runtime")
+    flags.add_argument(
+        "--stop-idle", action="store_true", help=argparse.SUPPRESS
+    )
+    parser.add_argument(
+        "--preload",
+        action="store_true",
+        help="with --start, load the model into memory",
+    )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help="with --init, download newer runtime and model",
+    )
+    parser.add_argument(
+        "--model",
+        action="append",
+        metavar="NAME",
+        help="with --init, model to download instead of SLLM_MODEL, "
+        "can be repeated",
+    )
+    parser.add_argument(
+        "--deep", action="store_true", help="with --status, query the model"
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="with --status, print machine-readable status",
+    )
+    parser.add_argument(
+        "--watch",
+        type=float,
+        nargs="?",
+        const=2.0,
+        metavar="SECONDS",
+        help="with --status, refresh the status periodically",
+    )
     parser.add_argument("--debug", action="store_true", help="nerd information")
 
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    cache_parser = commands.add_parser("cache", help="manage response cache")
+    cache_parser.add_argument("action", choices=["stats", "clear"])
+    cache_parser.add_argument(
+        "--debug", action="store_true", help="nerd information"
+    )
+
+    serve_parser = commands.add_parser("serve", help="run request broker")
+    serve_parser.add_argument(
+        "--debug", action="store_true", help="nerd information"
+    )
+
+    bench_parser = commands.add_parser("bench", help="measure the model")
+    bench_parser.add_argument(
+        "--iterations",
+        type=int,
+        default=3,
+        help="how many times to send each input",
+    )
+    bench_parser.add_argument(
+        "--concurrency",
+        type=int,
+        nargs="+",
+        default=[1],
+        help="requests sent at once, can be several levels",
+    )
+    bench_parser.add_argument(
+        "--cold",
+        action="store_true",
+        help="unload the model first to measure a cold start",
+    )
+    bench_parser.add_argument(
+        "--json", action="store_true", help="print machine-readable report"
+    )
+    bench_parser.add_argument(
+        "--debug", action="store_true", help="nerd information"
+    )
+
+    stats_parser = commands.add_parser("stats", help="show request statistics")
+    stats_parser.add_argument(
+        "--since",
+        default="24h",
+        help="time window, e.g. '1h' or '7d' (default: 24h)",
+    )
+    stats_parser.add_argument(
+        "--json", action="store_true", help="print machine-readable summary"
+    )
+    stats_parser.add_argument(
+        "--textfile",
+        type=pathlib.Path,
+        help="write metrics for the node_exporter textfile collector",
+    )
+    stats_parser.add_argument(
+        "--debug", action="store_true", help="nerd information"
+    )
+
     args = parser.parse_args()
+    if args.command == "stats":
+        stats(args.since, as_json=args.json, textfile=args.textfile)
+        return
+    if args.command == "bench":
+        bench(
+            iterations=max(args.iterations, 1),
+            concurrency=[max(level, 1) for level in args.concurrency],
+            cold=args.cold,
+            as_json=args.json,
+        )
+        return
+    if args.command == "cache":
+        cache(args.action)
+        return
+    if args.command == "serve":
+        try:
+            sllm.broker.Broker().serve()
+        except KeyboardInterrupt:
+            logger.info("Broker has been stopped.")
+        return
     if args.init:
-        sllm.container.ensure_runtime()
+        sllm.container.ensure_runtime(update=args.update, models=args.model)
         return
     if args.status:
-        status()
+        status(deep=args.deep, as_json=args.json, watch=args.watch)
         return
     if args.start:
+        # Requests ignore an invalid tuning file, report it here
+        sllm.tuning.profile()
         sllm.container.ensure_runtime()
-        sllm.container.ensure_started()
+        sllm.container.ensure_started(preload=False)
         sllm.container.schedule_shutdown()
-        print(f"Server is present at http://127.0.0.1:{sllm.common.API_PORT}.")
+        # Also when the server was already running
+        if args.preload:
+            sllm.container.preload_model(background=True)
+        print(
+            "Server is present at {urls}.".format(
+                urls=", ".join(
+                    sllm.common.api_url(i) for i in sllm.pool.instances()
+                )
+            )
+        )
+        return
+    if args.stop_idle:
+        sllm.container.stop_if_idle()
         return
     if args.stop:
         sllm.container._cancel_scheduled_shutdown()
-        if sllm.container.started():
-            sllm.container.shutdown()
+        sllm.container.shutdown()
         return
 
     parser.print_help()
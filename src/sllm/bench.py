@@ -0,0 +1,230 @@
+import concurrent.futures
+import dataclasses
+import datetime
+import importlib.resources
+import json
+import logging
+import time
+
+import requests
+
+import sllm.api
+import sllm.broker
+import sllm.client
+import sllm.common
+import sllm.container
+import sllm.metrics
+import sllm.readiness
+
+
+CORPUS_FILE: str = "bench.json"
+PERCENTILES: tuple[int, ...] = (50, 95, 99)
+
+logger = logging.getLogger(__name__)
+
+
+def load_corpus() -> list[tuple[str, str]]:
+    """Load the benchmark inputs shipped with sllm.
+
+    :returns: Pairs of the tool and its input.
+    """
+    raw: str = (
+        importlib.resources.files("sllm").joinpath(CORPUS_FILE).read_text()
+    )
+    corpus: dict[str, list[str]] = json.loads(raw)
+    return [(tool, text) for tool, texts in corpus.items() for text in texts]
+
+
+def build_request(tool: str, text: str) -> sllm.api.Request:
+    """Build the request the tool would send for the input.
+
+    Caching is disabled, every request reaches the model. The requests
+    are not added to the statistics, they would skew what real use shows.
+    """
+    request: sllm.api.Request
+    # Imported here, the tools depend on this package, not the other way
+    if tool == "git-message":
+        import _sllm_git_message
+
+        request = _sllm_git_message.build_request(text, cache=False)
+    elif tool == "translate":
+        import _sllm_translate
+
+        request = _sllm_translate.build_request(text, cache=False)
+    else:
+        raise ValueError(f"Unknown tool '{tool}'.")
+    request.record = False
+    return request
+
+
+@dataclasses.dataclass
+class Result:
+    """Measurements of a group of requests."""
+
+    name: str
+    concurrency: int
+    stats: list[sllm.api.Stats]
+    errors: int
+    elapsed: float
+
+    def summary(self) -> dict:
+        wall: list[float] = [s.wall_time for s in self.stats]
+        ttft: list[float] = [
+            s.time_to_first_token
+            for s in self.stats
+            if s.time_to_first_token is not None
+        ]
+        tps: list[float] = [s.tokens_per_second for s in self.stats]
+        prompt: list[float] = [
+            s.prompt_eval_duration / 10**9 for s in self.stats
+        ]
+        load: list[float] = [s.load_duration / 10**9 for s in self.stats]
+        tokens: int = sum(s.eval_count for s in self.stats)
+
+        def spread(values: list[float]) -> dict:
+            return {
+                f"p{p}": sllm.metrics.percentile(values, p) for p in PERCENTILES
+            }
+
+        return {
+            "name": self.name,
+            "concurrency": self.concurrency,
+            "requests": len(self.stats),
+            "errors": self.errors,
+            "throughput": tokens / self.elapsed if self.elapsed else 0.0,
+            "prompt_eval_count": sum(s.prompt_eval_count for s in self.stats),
+            "eval_count": tokens,
+            "wall_time": spread(wall),
+            "time_to_first_token": spread(ttft),
+            "tokens_per_second": spread(tps),
+            "prompt_eval_duration": spread(prompt),
+            "load_duration": spread(load),
+        }
+
+
+def _measure(tool: str, text: str) -> sllm.api.Stats:
+    request = build_request(tool, text)
+    # Streaming, so that the time to first token is known
+    for _ in request.stream():
+        pass
+    assert request.stats is not None
+    return request.stats
+
+
+def run(
+    name: str, inputs: list[tuple[str, str]], *, concurrency: int
+) -> Result:
+    """Send the inputs to the model and collect the timings.
+
+    :param name: Label of the group in the report.
+    :param inputs: Pairs of the tool and its input.
+    :param concurrency: How many requests to send at the same time.
+    """
+    logger.info(f"Running {len(inputs)} requests ({name}, x{concurrency}).")
+    stats: list[sllm.api.Stats] = []
+    errors: int = 0
+    start: float = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(_measure, *item) for item in inputs]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                stats.append(future.result())
+            except (
+                RuntimeError,
+                TimeoutError,
+                requests.exceptions.RequestException,
+            ) as exc:
+                logger.warning(f"Request failed: {exc}")
+                errors += 1
+    return Result(name, concurrency, stats, errors, time.monotonic() - start)
+
+
+def benchmark(*, iterations: int, concurrency: list[int], cold: bool) -> dict:
+    """Run the benchmark against the running server.
+
+    :param iterations: How many times to send each input, per level.
+    :param concurrency: Levels of concurrency to measure.
+    :param cold: Unload the model first, and measure the first request.
+    :returns: The report.
+    """
+    if sllm.broker.available():
+        logger.warning(
+            "Requests go through 'sllm serve', "
+            "identical concurrent requests are answered only once."
+        )
+    sllm.container.ensure_runtime()
+    sllm.container.ensure_started(preload=False)
+    if not sllm.readiness.ready():
+        raise RuntimeError("Model is malfunctioning.")
+
+    corpus: list[tuple[str, str]] = load_corpus()
+    results: list[Result] = []
+    if cold:
+        sllm.container.unload_model()
+        results.append(run("cold", corpus[:1], concurrency=1))
+    else:
+        sllm.container.preload_model()
+
+    for level in concurrency:
+        results.append(run("warm", corpus * iterations, concurrency=level))
+
+    model: dict = sllm.readiness.probe() or {}
+    version: str = sllm.client.shared().get("/api/version").json()["version"]
+    return {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "model": sllm.common.MODEL,
+        "digest": model.get("digest", ""),
+        "image": sllm.container.IMAGE,
+        "version": version,
+        "results": [result.summary() for result in results],
+    }
+
+
+def format_report(report: dict) -> str:
+    """Render the report as a table."""
+    header: list[str] = [
+        "run",
+        "conc",
+        "reqs",
+        "err",
+        "tok/s total",
+        "load s",
+        "prompt s p50",
+        "ttft s p50/p95/p99",
+        "wall s p50/p95/p99",
+        "tok/s p50",
+    ]
+
+    def number(value: float | None, digits: int = 2) -> str:
+        return "-" if value is None else f"{value:.{digits}f}"
+
+    def triple(values: dict) -> str:
+        return "/".join(number(values[f"p{p}"]) for p in PERCENTILES)
+
+    rows: list[list[str]] = [header]
+    for result in report["results"]:
+        rows.append(
+            [
+                result["name"],
+                str(result["concurrency"]),
+                str(result["requests"]),
+                str(result["errors"]),
+                f"{result['throughput']:.1f}",
+                number(result["load_duration"]["p50"]),
+                number(result["prompt_eval_duration"]["p50"]),
+                triple(result["time_to_first_token"]),
+                triple(result["wall_time"]),
+                number(result["tokens_per_second"]["p50"], 1),
+            ]
+        )
+
+    widths: list[int] = [
+        max(len(row[i]) for row in rows) for i in range(len(header))
+    ]
+    lines: list[str] = [
+        f"{report['model']} ({report['digest'][:12]}), "
+        f"ollama {report['version']}, {report['timestamp']}"
+    ]
+    for row in rows:
+        lines.append("  ".join(c.rjust(w) for c, w in zip(row, widths)))
+    return "\n".join(lines)
@@ -0,0 +1,273 @@
+import itertools
+import json
+import logging
+import pathlib
+import queue
+import signal
+import socket
+import socketserver
+import threading
+from typing import Iterator
+
+import sllm.cache
+import sllm.common
+import sllm.container
+import sllm.pool
+import sllm.readiness
+
+
+SOCKET_FILE: str = "broker.sock"
+# Lower number is served first
+PRIORITY_INTERACTIVE: int = 0
+PRIORITY_BATCH: int = 10
+
+logger = logging.getLogger(__name__)
+
+
+def socket_path() -> pathlib.Path:
+    return sllm.common.runtime_dir() / SOCKET_FILE
+
+
+class Connection:
+    def __init__(self, sock: socket.socket):
+        """Connection to the broker, carrying a single request."""
+        self.sock = sock
+        self.file = sock.makefile("rb")
+
+    def send(self, payload: dict, *, priority: int) -> None:
+        message: dict = {"payload": payload, "priority": priority}
+        self.sock.sendall(json.dumps(message).encode() + b"\n")
+
+    def lines(self) -> Iterator[bytes]:
+        """Read the streamed response, in the format of '/api/chat'.
+
+        :raises TimeoutError: The broker did not respond on time.
+        """
+        for line in self.file:
+            if line.strip():
+                yield line
+
+    def close(self) -> None:
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self) -> "Connection":
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+
+def connect(*, timeout: float | None = None) -> Connection | None:
+    """Connect to the broker.
+
+    :param timeout: Timeout for socket operations, in seconds.
+    :returns: The connection, or None if the broker is not running.
+    """
+    path = socket_path()
+    if not path.exists():
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(str(path))
+    except OSError as exc:
+        logger.debug(f"Broker is not running: {exc}.")
+        sock.close()
+        return None
+    return Connection(sock)
+
+
+def available() -> bool:
+    """Determine whether the broker is running."""
+    conn: Connection | None = connect(timeout=1)
+    if conn is None:
+        return False
+    conn.close()
+    return True
+
+
+class _Job:
+    def __init__(self, key: str, payload: dict, priority: int):
+        """Single inference, shared by all identical requests."""
+        self.key: str = key
+        self.payload: dict = payload
+        self.priority: int = priority
+        self.lines: list[bytes] = []
+        self.done: bool = False
+        self.cond = threading.Condition()
+
+    def append(self, line: bytes) -> None:
+        with self.cond:
+            self.lines.append(line)
+            self.cond.notify_all()
+
+    def finish(self) -> None:
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+
+    def follow(self) -> Iterator[bytes]:
+        """Read all lines of the response, including those already sent."""
+        index: int = 0
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: len(self.lines) > index or self.done)
+                lines: list[bytes] = self.lines[index:]
+                done: bool = self.done
+            yield from lines
+            index += len(lines)
+            if done and index == len(self.lines):
+                return
+
+
+class Broker:
+    def __init__(self, *, workers: int = sllm.common.CAPACITY):
+        """Request broker, shared by all local clients.
+
+        Requests wait in a priority queue until one of the workers is
+        free. Identical requests that are queued or being processed at
+        the same time are answered by a single inference.
+
+        Queued requests sharing a system prompt are kept together, so
+        that the server can reuse the evaluated prompt instead of
+        alternating between unrelated ones.
+
+        :param workers: How many requests to send to the server at once.
+        """
+        self.workers: int = workers
+        self.queue: queue.PriorityQueue = queue.PriorityQueue()
+        self.jobs: dict[str, _Job] = {}
+        self.jobs_lock = threading.Lock()
+        self.runtime_lock = threading.Lock()
+        self._sequence = itertools.count()
+        # Prefix -> queue position and number of queued jobs
+        self.groups: dict[str, list[int]] = {}
+
+    def submit(self, payload: dict, priority: int) -> _Job:
+        """Enqueue a request, or join an identical one."""
+        payload = dict(payload, stream=True)
+        key: str = sllm.cache.key("", payload)
+        with self.jobs_lock:
+            job: _Job | None = self.jobs.get(key)
+            if job is not None:
+                logger.debug(f"Joining request {key[:12]}.")
+                return job
+
+            job = _Job(key, payload, priority)
+            self.jobs[key] = job
+        logger.debug(f"Queueing request {key[:12]} (priority {priority}).")
+        self.queue.put(
+            (priority, self._position(job), next(self._sequence), job)
+        )
+        return job
+
+    @staticmethod
+    def _prefix(payload: dict) -> str:
+        messages: list[dict] = payload.get("messages") or [{}]
+        return sllm.cache.key(
+            "", {"model": payload.get("model"), **messages[0]}
+        )
+
+    def _position(self, job: _Job) -> int:
+        """Place the job right after queued jobs with the same prefix."""
+        prefix: str = self._prefix(job.payload)
+        with self.jobs_lock:
+            group: list[int] | None = self.groups.get(prefix)
+            if group is None:
+                group = [next(self._sequence), 0]
+                self.groups[prefix] = group
+            group[1] += 1
+            return group[0]
+
+    def _dequeued(self, job: _Job) -> None:
+        prefix: str = self._prefix(job.payload)
+        with self.jobs_lock:
+            group: list[int] | None = self.groups.get(prefix)
+            if group is not None:
+                group[1] -= 1
+                if group[1] <= 0:
+                    del self.groups[prefix]
+
+    def _ensure_runtime(self) -> None:
+        with self.runtime_lock:
+            if sllm.container.missing():
+                sllm.container.ensure_runtime()
+                sllm.container.ensure_started()
+            if not sllm.readiness.ready():
+                raise RuntimeError("Model is malfunctioning.")
+
+    def _process(self, job: _Job) -> None:
+        """Send the request to the server and pass the response on.
+
+        Any failure, including one to start the server, is passed on as
+        an error line, so that the waiting clients learn about it and the
+        worker stays alive.
+        """
+        logger.debug(f"Processing request {job.key[:12]}.")
+        try:
+            self._ensure_runtime()
+            with sllm.pool.post("/api/chat", job.payload, stream=True) as resp:
+                for line in resp.iter_lines():
+                    if line:
+                        job.append(line + b"\n")
+        except Exception as exc:
+            # Some exceptions, e.g. TimeoutError, come without a message
+            error: str = str(exc) or type(exc).__name__
+            logger.warning(f"Request {job.key[:12]} failed: {error}")
+            job.append(json.dumps({"error": error}).encode() + b"\n")
+        finally:
+            with self.jobs_lock:
+                self.jobs.pop(job.key, None)
+            job.finish()
+
+    def _work(self) -> None:
+        while True:
+            *_, job = self.queue.get()
+            self._dequeued(job)
+            self._process(job)
+
+    def serve(self) -> None:
+        """Serve requests until interrupted."""
+        self._ensure_runtime()
+
+        for _ in range(self.workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+        broker = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self) -> None:
+                line: bytes = self.rfile.readline()
+                if not line.strip():
+                    # Availability check
+                    return
+                message: dict = json.loads(line)
+                job: _Job = broker.submit(
+                    message["payload"],
+                    message.get("priority", PRIORITY_INTERACTIVE),
+                )
+                try:
+                    for chunk in job.follow():
+                        self.wfile.write(chunk)
+                        self.wfile.flush()
+                except BrokenPipeError:
+                    logger.debug("Client went away.")
+
+        path = socket_path()
+        path.unlink(missing_ok=True)
+        server = socketserver.ThreadingUnixStreamServer(str(path), Handler)
+        server.daemon_threads = True
+        path.chmod(0o600)
+        logger.info(f"Serving requests at {path}.")
+
+        def terminate(signum: int, frame: object) -> None:
+            raise KeyboardInterrupt
+
+        signal.signal(signal.SIGTERM, terminate)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            path.unlink(missing_ok=True)
@@ -0,0 +1,173 @@
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+import time
+import zlib
+
+import sllm.common
+
+
+MAX_SIZE: int = int(os.getenv("SLLM_CACHE_SIZE", str(16 * 2**20)))
+DATABASE: str = "responses.sqlite"
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+CREATE TABLE IF NOT EXISTS digests (
+    model TEXT PRIMARY KEY,
+    digest TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+def key(digest: str, payload: dict) -> str:
+    """Compute the cache key of a request.
+
+    :param digest: Digest of the model that would answer the request.
+    :param payload: The API request.
+    """
+    # These do not influence the response
+    payload = {
+        k: v for k, v in payload.items() if k not in ("stream", "keep_alive")
+    }
+    if "options" in payload:
+        payload["options"] = {
+            k: v for k, v in payload["options"].items() if k != "num_thread"
+        }
+    raw: str = json.dumps(
+        {"digest": digest, "payload": payload},
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class Cache:
+    def __init__(
+        self, path: pathlib.Path | None = None, *, max_size: int = MAX_SIZE
+    ):
+        """Open the on-disk response cache.
+
+        Responses are stored compressed. When the cache grows over its
+        maximal size, least recently used responses are evicted.
+
+        :param path: Database file, defaults to one in the cache directory.
+        :param max_size: Maximal size of stored responses, in bytes.
+        """
+        if path is None:
+            path = sllm.common.cache_dir() / DATABASE
+        self.path: pathlib.Path = path
+        self.max_size: int = max_size
+        self.db = sqlite3.connect(path, timeout=5, isolation_level=None)
+        self.db.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def _count(self, name: str) -> None:
+        self.db.execute(
+            "INSERT INTO counters (name, value) VALUES (?, 1) "
+            "ON CONFLICT (name) DO UPDATE SET value = value + 1",
+            (name,),
+        )
+
+    def get(self, key: str) -> str | None:
+        """Look up a response.
+
+        :returns: The stored response, if there is one.
+        """
+        row = self.db.execute(
+            "SELECT value FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self._count("misses")
+            return None
+
+        self.db.execute(
+            "UPDATE responses SET accessed = ? WHERE key = ?",
+            (time.time(), key),
+        )
+        self._count("hits")
+        return zlib.decompress(row[0]).decode()
+
+    def put(self, key: str, value: str) -> None:
+        """Store a response, evicting old ones if necessary."""
+        blob: bytes = zlib.compress(value.encode())
+        self.db.execute(
+            "INSERT OR REPLACE INTO responses (key, value, size, accessed) "
+            "VALUES (?, ?, ?, ?)",
+            (key, blob, len(blob), time.time()),
+        )
+        self._evict()
+
+    def _evict(self) -> None:
+        size: int = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+        if size <= self.max_size:
+            return
+
+        rows = self.db.execute(
+            "SELECT key, size FROM responses ORDER BY accessed ASC"
+        ).fetchall()
+        evicted: int = 0
+        for row_key, row_size in rows:
+            if size <= self.max_size:
+                break
+            self.db.execute("DELETE FROM responses WHERE key = ?", (row_key,))
+            size -= row_size
+            evicted += 1
+        logger.debug(f"Evicted {evicted} responses from the cache.")
+
+    def digest(self, model: str) -> str | None:
+        """Get the last known digest of a model."""
+        row = self.db.execute(
+            "SELECT digest FROM digests WHERE model = ?", (model,)
+        ).fetchone()
+        return None if row is None else str(row[0])
+
+    def set_digest(self, model: str, digest: str) -> None:
+        """Remember the digest of a model."""
+        self.db.execute(
+            "INSERT OR REPLACE INTO digests (model, digest) VALUES (?, ?)",
+            (model, digest),
+        )
+
+    def stats(self) -> dict:
+        """Describe the cache content.
+
+        :returns: Number of entries, their size, hits and misses.
+        """
+        entries, size = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        counters: dict = dict(
+            self.db.execute("SELECT name, value FROM counters").fetchall()
+        )
+        return {
+            "entries": entries,
+            "size": size,
+            "max_size": self.max_size,
+            "hits": counters.get("hits", 0),
+            "misses": counters.get("misses", 0),
+        }
+
+    def clear(self) -> None:
+        """Drop all stored responses and statistics."""
+        self.db.execute("DELETE FROM responses")
+        self.db.execute("DELETE FROM counters")
+        self.db.execute("VACUUM")
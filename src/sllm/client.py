@@ -0,0 +1,149 @@
+"""HTTP client for the API of the server.
+
+Importing 'requests' takes longer than most commands take to run, and
+longer than answering from the response cache. Other modules import it
+and this module only inside the functions that talk to the server;
+'tools/startup_bench.py' checks that commands which do not talk to it
+never import them.
+"""
+
+import json
+import logging
+import threading
+
+import requests
+import requests.adapters
+import urllib3.util.retry
+
+import sllm.common
+
+
+# Connection timeout can be very low, we're on localhost
+CONNECT_TIMEOUT: float = 0.5
+# Read timeouts, in seconds
+TIMEOUTS: dict[str, float] = {
+    "/": 2,
+    "/api/version": 2,
+    "/api/tags": 5,
+    "/api/ps": 2,
+    "/api/chat": 120,
+    "/api/pull": 3600,
+}
+DEFAULT_TIMEOUT: float = 30
+
+logger = logging.getLogger(__name__)
+
+
+class Client:
+    def __init__(
+        self,
+        base_url: str = sllm.common.API_URL,
+        *,
+        pool_size: int = 10,
+        retries: int = 2,
+    ):
+        """Build an HTTP client for the ollama API.
+
+        Connections are kept open and reused between requests.
+
+        :param base_url: Address of the server.
+        :param pool_size: How many connections to keep open.
+        :param retries:
+            How many times to retry a request that could not connect.
+            Requests that have already been sent are never retried.
+        """
+        self.base_url: str = base_url
+        self.session = requests.Session()
+
+        retry = urllib3.util.retry.Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=0,
+            other=0,
+            backoff_factor=0.1,
+            raise_on_status=False,
+        )
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.session.mount("http://", adapter)
+        self.session.headers.update(
+            {
+                "Accept-Encoding": "gzip, deflate",
+                "Content-Type": "application/json",
+            }
+        )
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        *,
+        payload: dict | None = None,
+        stream: bool = False,
+        timeout: float | None = None,
+    ) -> requests.Response:
+        """Send a request to the server.
+
+        :param method: HTTP method.
+        :param path: API endpoint, e.g. '/api/chat'.
+        :param payload: JSON body of the request.
+        :param stream: Do not read the response body immediately.
+        :param timeout: Read timeout, defaults to the endpoint's timeout.
+        :raises requests.exceptions.RequestException:
+        """
+        if timeout is None:
+            timeout = TIMEOUTS.get(path, DEFAULT_TIMEOUT)
+
+        data: bytes | None = None
+        if payload is not None:
+            data = json.dumps(payload, separators=(",", ":")).encode()
+
+        return self.session.request(
+            method,
+            f"{self.base_url}{path}",
+            data=data,
+            stream=stream,
+            timeout=(CONNECT_TIMEOUT, timeout),
+        )
+
+    def get(
+        self, path: str, *, timeout: float | None = None
+    ) -> requests.Response:
+        """Send a GET request to the server."""
+        return self.request("GET", path, timeout=timeout)
+
+    def post(
+        self,
+        path: str,
+        payload: dict,
+        *,
+        stream: bool = False,
+        timeout: float | None = None,
+    ) -> requests.Response:
+        """Send a POST request to the server."""
+        return self.request(
+            "POST", path, payload=payload, stream=stream, timeout=timeout
+        )
+
+    def close(self) -> None:
+        """Close all open connections."""
+        self.session.close()
+
+
+_shared: dict[int, Client] = {}
+_shared_lock = threading.Lock()
+
+
+def shared(instance: int = 0) -> Client:
+    """Get the client shared by the whole process.
+
+    :param instance: Server to send the requests to, see 'sllm.pool'.
+    """
+    with _shared_lock:
+        if instance not in _shared:
+            url: str = sllm.common.api_url(instance)
+            logger.debug(f"Creating HTTP client for {url}.")
+            _shared[instance] = Client(url)
+        return _shared[instance]
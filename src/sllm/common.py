@@ -1,10 +1,176 @@
 import logging
+import math
 import os
+import pathlib
+import re
+import subprocess
 import sys
+import tempfile
 
+# Port of the first server, the others use the following ports
 API_PORT: int = 6574
 API_URL: str = f"http://127.0.0.1:{API_PORT}"
 MODEL: str = os.getenv("SLLM_MODEL", "llama3.2:3b")
+# How many requests each server processes at the same time
+PARALLEL: int = int(os.getenv("SLLM_PARALLEL", "1"))
+# How many servers to run, see 'sllm.pool'
+INSTANCES: int = max(int(os.getenv("SLLM_INSTANCES", "1")), 1)
+# How many requests all servers process at the same time
+CAPACITY: int = PARALLEL * INSTANCES
+# Context window of most requests, in tokens; larger inputs get multiples
+CONTEXT: int = int(os.getenv("SLLM_CONTEXT", "4096"))
+# Largest context window sllm asks for; longer inputs are refused
+MAX_CONTEXT: int = int(os.getenv("SLLM_MAX_CONTEXT", "32768"))
+
+# Units of systemd time spans, see systemd.time(7); they are case-sensitive
+_INTERVAL_UNITS: dict[str, float] = {
+    "usec": 10**-6,
+    "us": 10**-6,
+    "\u00b5s": 10**-6,
+    "msec": 10**-3,
+    "ms": 10**-3,
+    "seconds": 1,
+    "second": 1,
+    "sec": 1,
+    "s": 1,
+    "": 1,
+    "minutes": 60,
+    "minute": 60,
+    "min": 60,
+    "m": 60,
+    "hours": 3600,
+    "hour": 3600,
+    "hr": 3600,
+    "h": 3600,
+    "days": 86400,
+    "day": 86400,
+    "d": 86400,
+    "weeks": 7 * 86400,
+    "week": 7 * 86400,
+    "w": 7 * 86400,
+    "months": 2629800,
+    "month": 2629800,
+    "M": 2629800,
+    "years": 31557600,
+    "year": 31557600,
+    "y": 31557600,
+}
+_INTERVAL_PART = re.compile(r"\s*(\d+(?:\.\d+)?)\s*([^\d\s.]*)")
+
+
+def parse_interval(interval: str) -> float:
+    """Convert systemd time span into seconds.
+
+    :param interval: Time span, e.g. '15m', '1.5h' or '1h 30min'.
+    :raises ValueError: The time span is not valid.
+    """
+    text: str = interval.strip()
+    if not text:
+        raise ValueError("Invalid time span, it is empty.")
+    seconds: float = 0
+    position: int = 0
+    while position < len(text):
+        match = _INTERVAL_PART.match(text, position)
+        if match is None:
+            raise ValueError(f"Invalid time span '{interval}'.")
+        value, unit = match.groups()
+        if unit not in _INTERVAL_UNITS:
+            raise ValueError(
+                f"Invalid time span '{interval}': unknown unit '{unit}'."
+            )
+        seconds += float(value) * _INTERVAL_UNITS[unit]
+        position = match.end()
+    return seconds
+
+
+def _parse_variable(variable: str, value: str) -> float:
+    try:
+        return parse_interval(value)
+    except ValueError as exc:
+        raise ValueError(f"{variable}: {exc}") from None
+
+
+SHUTDOWN_INTERVAL: str = os.getenv("SLLM_SHUTDOWN_INTERVAL", "15m")
+
+
+def shutdown_interval() -> float:
+    """Get how long the server runs without requests, in seconds.
+
+    :raises ValueError: 'SLLM_SHUTDOWN_INTERVAL' is not a valid time span.
+    """
+    return _parse_variable("SLLM_SHUTDOWN_INTERVAL", SHUTDOWN_INTERVAL)
+
+
+def keep_alive() -> int:
+    """Get how long the server keeps the model in memory after a request.
+
+    Negative numbers keep it in memory for as long as the server runs,
+    as they do in the API of the server.
+
+    :returns: Time in seconds.
+    :raises ValueError: 'SLLM_KEEP_ALIVE' is not a valid time span.
+    """
+    value: str | None = os.getenv("SLLM_KEEP_ALIVE")
+    if value is None:
+        return math.ceil(shutdown_interval())
+    if re.fullmatch(r"\s*-\d+\s*", value):
+        return int(value)
+    return math.ceil(_parse_variable("SLLM_KEEP_ALIVE", value))
+
+
+def api_url(instance: int = 0) -> str:
+    """Get the address of a server."""
+    return f"http://127.0.0.1:{API_PORT + instance}"
+
+
+def runtime_dir() -> pathlib.Path:
+    """Get the directory for volatile state.
+
+    The directory is created if it does not exist yet.
+    """
+    base: str | None = os.getenv("XDG_RUNTIME_DIR")
+    if base:
+        path = pathlib.Path(base) / "sllm"
+    else:
+        path = pathlib.Path(tempfile.gettempdir()) / f"sllm-{os.getuid()}"
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    return path
+
+
+def cache_dir() -> pathlib.Path:
+    """Get the directory for persistent, but disposable data.
+
+    The directory is created if it does not exist yet.
+    """
+    base: str = os.getenv("XDG_CACHE_HOME") or str(
+        pathlib.Path.home() / ".cache"
+    )
+    path = pathlib.Path(base) / "sllm"
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def detach(
+    code: str, *, cwd: str | None = None, pass_fds: tuple[int, ...] = ()
+) -> None:
+    """Run Python code in a new process that outlives this one.
+
+    The process runs in its own session, without a terminal, so that
+    it is not stopped when the command that started it exits.
+
+    :param code: The code to run, e.g. 'import sllm; sllm.main()'.
+    :param cwd: Directory to run it in.
+    :param pass_fds: Descriptors the process inherits.
+    """
+    subprocess.Popen(
+        [sys.executable, "-c", code],
+        cwd=cwd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+        pass_fds=pass_fds,
+    )
 
 
 def use_color() -> bool:
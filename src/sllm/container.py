@@ -1,77 +1,331 @@
+import concurrent.futures
+import fcntl
 import logging
 import os
 import subprocess
+import sys
 import time
 import json
+import sqlite3
 
-import requests
-
+import sllm.activity
+import sllm.cache
 import sllm.common
+import sllm.pool
+import sllm.pull
+import sllm.readiness
+import sllm.trace
+import sllm.tuning
 
 
 IMAGE: str = os.getenv("SLLM_OLLAMA", "docker.io/ollama/ollama:latest")
 NAME: str = "sllm"
 SHUTDOWN_NAME: str = "sllm-shutdown"
-SHUTDOWN_INTERVAL: str = os.getenv("SLLM_SHUTDOWN_INTERVAL", "15m")
+SHUTDOWN_INTERVAL: str = sllm.common.SHUTDOWN_INTERVAL
+# How often to check whether the container is idle
+IDLE_CHECK_INTERVAL: str = "1min"
+# Held by the process warming up the runtime, see 'warm_up()'
+WARM_LOCK: str = "warm.lock"
+# Where the other servers of the pool find the models of the first one
+SHARED_MODELS: str = "/shared"
 
 logger = logging.getLogger(__name__)
 
 
-def ensure_runtime() -> None:
-    """Download the ollama container.
+def name(instance: int = 0) -> str:
+    """Get the name of the container running the server."""
+    return NAME if instance == 0 else f"{NAME}-{instance}"
+
+
+def _lock_warm_up(*, blocking: bool) -> int | None:
+    """Take the warm-up lock.
 
-    :raises RuntimeError: 'podman pull' failed.
+    The lock is released when the returned descriptor is closed, or
+    when the process holding it exits.
+
+    :returns: Descriptor of the lock file, or None if it is taken.
     """
-    logger.debug(f"Downloading '{IMAGE}'.")
-    cmd_ollama = ["podman", "pull", IMAGE]
-    proc_ollama = subprocess.run(cmd_ollama, text=True, capture_output=True)
-    if proc_ollama.returncode > 0:
-        logger.critical(f"'podman pull' returned {proc_ollama.returncode}.")
-        raise RuntimeError(f"Couldn't pull '{IMAGE}'.")
+    fd: int = os.open(
+        sllm.common.runtime_dir() / WARM_LOCK, os.O_RDWR | os.O_CREAT, 0o600
+    )
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _wait_for_warm_up() -> None:
+    """Wait until a warm-up running in another process finishes.
+
+    Starting the container at the same time would fail on its name.
+    """
+    fd: int | None = _lock_warm_up(blocking=False)
+    if fd is None:
+        logger.info("Waiting for the runtime to warm up.")
+        with sllm.trace.span("wait_for_warm_up"):
+            fd = _lock_warm_up(blocking=True)
+    if fd is not None:
+        os.close(fd)
+
+
+def warm_up(*, background: bool = False, lock: int | None = None) -> None:
+    """Start the server and load the model ahead of the first request.
+
+    Only one warm-up runs at a time, others return right away. Processes
+    calling 'ensure_runtime()' meanwhile wait for it to finish.
+
+    :param background:
+        Do not wait for the warm-up to finish. The lock is taken before
+        returning, so that 'ensure_runtime()' called right afterwards
+        waits for the warm-up instead of starting the container too.
+    :param lock: Descriptor of the warm-up lock, already taken.
+    """
+    fd: int | None = lock
+    if fd is None:
+        fd = _lock_warm_up(blocking=False)
+    if fd is None:
+        logger.debug("Runtime is already warming up.")
+        return
+
+    if background:
+        logger.debug("Warming up the runtime in the background.")
+        try:
+            # The worker inherits the lock and holds it until it exits
+            sllm.common.detach(
+                f"import sllm.container; sllm.container.warm_up(lock={fd})",
+                pass_fds=(fd,),
+            )
+        finally:
+            os.close(fd)
+        return
+
+    try:
+        _ensure_runtime(update=False)
+        ensure_started(preload=False)
+        preload_model()
+    finally:
+        os.close(fd)
+
+
+@sllm.trace.traced("ensure_runtime")
+def ensure_runtime(
+    *, update: bool = False, models: list[str] | None = None
+) -> None:
+    """Download the ollama container and the models.
+
+    If the server is already running and has the models, this only
+    takes a single HTTP request. The container and the models are only
+    downloaded when they are missing, unless an update is requested.
+    When the server is running already, the models are downloaded while
+    the container is.
+
+    :param update: Download newer container and models, if there are any.
+    :param models: Models to download, defaults to 'SLLM_MODEL'.
+    :raises RuntimeError: The container or the models couldn't be pulled.
+    """
+    _wait_for_warm_up()
+    _ensure_runtime(update=update, models=models)
+
+
+def _ensure_runtime(*, update: bool, models: list[str] | None = None) -> None:
+    wanted: list[str] = [
+        sllm.pull.full_name(model) for model in models or [sllm.common.MODEL]
+    ]
+    present: dict[str, str] | None = sllm.pull.installed()
+    if not update and present is not None and set(wanted) <= set(present):
+        logger.debug("Runtime is ready.")
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(1) as pool:
+        image: concurrent.futures.Future | None = None
+        if update or not _image_present():
+            image = pool.submit(_pull_image)
 
-    if not started():
-        start()
-        wait_for_start()
-        schedule_shutdown()
+        if present is None and not started():
+            if image is not None:
+                image.result()
+            start()
+            wait_for_start()
 
-    logger.debug(f"Downloading '{sllm.common.MODEL}'.")
+        digests: dict[str, str] = sllm.pull.pull_all(wanted, update=update)
+        if image is not None:
+            image.result()
 
-    cmd_model = ["podman", "exec", "-it", NAME]
-    cmd_model += ["ollama", "pull", sllm.common.MODEL]
-    proc = subprocess.run(cmd_model, text=True, capture_output=True)
+    digest: str | None = digests.get(sllm.pull.full_name(sllm.common.MODEL))
+    if digest:
+        _model_pulled(digest)
+
+
+def _model_pulled(digest: str) -> None:
+    """Forget what was known about the previous version of the model.
+
+    :param digest: Digest of the model that has just been downloaded.
+    """
+    state: dict | None = sllm.readiness.load_state()
+    if state is not None and state.get("digest") != digest:
+        # The model has changed, it has to be verified again
+        sllm.readiness.invalidate()
+
+    # Responses are cached under the digest, the old ones must not match
+    try:
+        cache = sllm.cache.Cache()
+        try:
+            cache.set_digest(sllm.common.MODEL, digest)
+        finally:
+            cache.close()
+    except sqlite3.Error as exc:
+        logger.warning(f"Cannot update the response cache: {exc}.")
+
+
+@sllm.trace.traced("pull_image")
+def _pull_image() -> None:
+    logger.info(f"Downloading '{IMAGE}'.")
+    cmd = ["podman", "pull", "--quiet", IMAGE]
+    proc = subprocess.run(cmd, text=True, capture_output=True)
     if proc.returncode > 0:
-        logger.critical(f"'ollama pull' returned {proc.returncode}.")
-        raise RuntimeError(f"Couldn't pull model '{sllm.common.MODEL}'.")
-    logger.debug("Downloaded.")
+        logger.critical(f"'podman pull' returned {proc.returncode}.")
+        logger.debug(f"Command {cmd} failed: {proc.stderr.strip()}")
+        raise RuntimeError(f"Couldn't pull '{IMAGE}'.")
+    logger.debug(f"'{IMAGE}' has been downloaded.")
 
 
-def ensure_started() -> None:
+@sllm.trace.traced("ensure_started")
+def ensure_started(*, preload: bool = True) -> None:
     """Start the ramalama server.
 
-    Does nothing if the server is already running.
+    Does nothing if all servers of the pool are already running. The
+    first one is started first, the others use its models. Once they
+    run, their shutdown is scheduled.
 
+    :param preload: Start loading the model once the server starts.
     :raises TimeoutError: Server did not start fast enough.
     """
-    if started():
+    stopped: list[int] = missing()
+    if not stopped:
         return
 
-    start()
+    if 0 in stopped:
+        # The others need the models directory it creates
+        start(0)
+        wait_for_start(0)
+    others: list[int] = [i for i in stopped if i != 0]
+    for instance in others:
+        start(instance)
+    for instance in others:
+        wait_for_start(instance)
+    # One timer watches all servers of the pool
+    schedule_shutdown()
 
-    for _ in range(10):
-        time.sleep(0.5)
-        if started():
-            logger.debug("Server is now running.")
-            return
+    if preload:
+        preload_model(background=True)
 
-    raise TimeoutError
 
+def preload_model(*, background: bool = False) -> None:
+    """Load the model into memory.
+
+    Requests sent afterwards do not have to wait for the model to load.
+
+    :param background: Do not wait for the model to load.
+    """
+    if background:
+        logger.debug("Loading the model in the background.")
+        sllm.common.detach(
+            "import sllm.container; sllm.container.preload_model()"
+        )
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(sllm.common.INSTANCES) as pool:
+        list(pool.map(_preload_model, sllm.pool.instances()))
+
+
+def _preload_model(instance: int) -> None:
+    import requests
+    import sllm.client
+
+    logger.debug(f"Loading '{sllm.common.MODEL}' into memory of {instance}.")
+    try:
+        with (
+            sllm.activity.request(instance),
+            sllm.trace.span("preload_model"),
+        ):
+            resp = sllm.client.shared(instance).post(
+                "/api/chat",
+                {
+                    "model": sllm.common.MODEL,
+                    "messages": [],
+                    "keep_alive": sllm.common.keep_alive(),
+                    "options": {
+                        "num_ctx": sllm.common.CONTEXT,
+                        **sllm.tuning.options(),
+                    },
+                },
+            )
+    except requests.exceptions.RequestException as exc:
+        logger.warning(f"Model could not be loaded: {exc}.")
+        return
+    if not resp.ok:
+        logger.warning(f"Model could not be loaded: {resp.text.strip()}")
+        return
+    logger.debug("Model has been loaded.")
+
+
+def unload_model() -> None:
+    """Remove the model from memory, without stopping the servers."""
+    import sllm.client
+
+    logger.debug(f"Unloading '{sllm.common.MODEL}' from memory.")
+    for instance in sllm.pool.instances():
+        resp = sllm.client.shared(instance).post(
+            "/api/chat",
+            {"model": sllm.common.MODEL, "messages": [], "keep_alive": 0},
+        )
+        if not resp.ok:
+            logger.warning(f"Model could not be unloaded: {resp.text.strip()}")
+
+
+def _image_present() -> bool:
+    cmd = ["podman", "image", "exists", IMAGE]
+    proc = subprocess.run(cmd, text=True, capture_output=True)
+    return proc.returncode == 0
+
+
+def responding(instance: int = 0) -> bool:
+    """Query the HTTP API.
+
+    This is cheaper than 'started()', which inspects the container too.
+
+    :param instance: Server of the pool to query.
+    :returns: True if the API responds.
+    """
+    import sllm.client
+
+    try:
+        resp = sllm.client.shared(instance).get("/")
+    except Exception as exc:
+        logger.debug(f"HTTP API is not running: {exc}.")
+        return False
+
+    if not resp.ok:
+        logger.debug("HTTP API is not well.")
+        return False
+
+    return True
+
+
+def missing() -> list[int]:
+    """Find the servers of the pool whose HTTP API does not respond."""
+    return [i for i in sllm.pool.instances() if not responding(i)]
 
-def started() -> bool:
+
+def started(instance: int = 0) -> bool:
     """Query the ramalama server for status.
 
+    :param instance: Server of the pool to query.
     :returns: True if ramalama is ready to serve requests.
     """
-    cmd = ["podman", "inspect", NAME]
+    cmd = ["podman", "inspect", name(instance)]
     proc = subprocess.run(cmd, text=True, capture_output=True)
     if proc.returncode > 0:
         logger.debug("Container is not running.")
@@ -84,49 +338,61 @@ def started() -> bool:
         logger.debug(f"Container is running in unexpected state of '{status}'.")
         return False
 
-    try:
-        resp = requests.get(f"{sllm.common.API_URL}/")
-    except Exception as exc:
-        logger.debug(f"HTTP API is not running: {exc}.")
-        return False
-
-    if not resp.ok:
-        logger.debug("HTTP API is not well.")
+    if not responding(instance):
         return False
 
     logger.debug("Runtime is running.")
     return True
 
 
-def start() -> None:
+@sllm.trace.traced("start_container")
+def start(instance: int = 0) -> None:
     """Start the ramalama server.
 
+    Only the first server of the pool can modify the models. The others
+    get them read-only, and keep the rest of their state to themselves.
+
+    :param instance: Server of the pool to start.
     :raises RuntimeError:
     """
     cmd = ["podman", "run"]
     # cmd += ["--gpus", "all"]  # This errors out without Nvidia GPU
     cmd += ["--detach"]
     cmd += ["--rm"]
-    cmd += ["--volume", "ollama:/root/.ollama"]
-    cmd += ["--publish", f"{str(sllm.common.API_PORT)}:11434"]
-    cmd += ["--name", NAME]
+    if instance == 0:
+        cmd += ["--volume", "ollama:/root/.ollama"]
+    else:
+        cmd += ["--volume", f"ollama:{SHARED_MODELS}:ro"]
+        cmd += ["--env", f"OLLAMA_MODELS={SHARED_MODELS}/models"]
+        # Do not try to remove unused blobs on start
+        cmd += ["--env", "OLLAMA_NOPRUNE=1"]
+    cmd += ["--publish", f"{sllm.common.API_PORT + instance}:11434"]
+    cmd += sllm.tuning.podman_args(instance)
+    cmd += ["--env", f"OLLAMA_KEEP_ALIVE={sllm.common.keep_alive()}s"]
+    cmd += ["--name", name(instance)]
     cmd += [IMAGE]
 
-    logger.info("Starting the container.")
+    logger.info(f"Starting the container '{name(instance)}'.")
+    sllm.readiness.invalidate()
     proc = subprocess.run(cmd, text=True, capture_output=True)
     if proc.returncode > 0:
         logger.debug(f"Command {cmd} failed: {proc.stderr.strip()}")
         raise RuntimeError("Server could not be started.")
 
+    # The idle time is counted from the start
+    sllm.activity.touch()
+
 
-def wait_for_start() -> None:
+@sllm.trace.traced("wait_for_start")
+def wait_for_start(instance: int = 0) -> None:
     """Wait for the server to start.
 
+    :param instance: Server of the pool to wait for.
     :raises TimeoutError: Server didn't start on time.
     """
     for _ in range(10):
         time.sleep(0.5)
-        if started():
+        if started(instance):
             logger.debug("Server is now running.")
             return
 
@@ -144,17 +410,28 @@ def _cancel_scheduled_shutdown() -> None:
 
 
 def schedule_shutdown() -> None:
-    """Schedule the container to shut down.
+    """Schedule the container to shut down once it is idle.
+
+    Sets a systemd timer that periodically checks when the last request
+    has been completed, and stops the container once it has been idle
+    for the shutdown interval. Consecutive execution will cancel the
+    previous timer and set up a new one.
 
-    Sets a systemd timer to stop the container. Consecutive execution
-    will cancel the previous timer and set up a new one.
+    :raises ValueError: The shutdown interval is not valid.
     """
+    # The timer would fail every minute, where nobody sees it
+    sllm.common.shutdown_interval()
     _cancel_scheduled_shutdown()
 
     cmd = ["systemd-run", "--user"]
     cmd += ["--unit", SHUTDOWN_NAME]
-    cmd += ["--on-active", SHUTDOWN_INTERVAL]
-    cmd += ["podman", "stop", NAME]
+    cmd += ["--on-active", IDLE_CHECK_INTERVAL]
+    cmd += ["--on-unit-active", IDLE_CHECK_INTERVAL]
+    cmd += [f"--setenv=SLLM_SHUTDOWN_INTERVAL={SHUTDOWN_INTERVAL}"]
+    cmd += [f"--setenv=SLLM_INSTANCES={sllm.common.INSTANCES}"]
+    if os.getenv("XDG_RUNTIME_DIR"):
+        cmd += [f"--setenv=XDG_RUNTIME_DIR={os.environ['XDG_RUNTIME_DIR']}"]
+    cmd += [sys.executable, "-m", "sllm", "--stop-idle"]
 
     proc = subprocess.run(cmd, text=True, capture_output=True)
     if proc.returncode > 0:
@@ -163,9 +440,23 @@ def schedule_shutdown() -> None:
     logger.debug("Container shutdown has been scheduled.")
 
 
+def stop_if_idle() -> None:
+    """Shut down the container if it has not been used recently."""
+    idle: float = sllm.activity.idle()
+    limit: float = sllm.common.shutdown_interval()
+    if idle < limit:
+        logger.debug(f"Container has been idle for {idle:.0f} s, keeping it.")
+        return
+
+    logger.debug(f"Container has been idle for {idle:.0f} s, stopping it.")
+    _cancel_scheduled_shutdown()
+    shutdown()
+
+
 def shutdown() -> None:
-    """Shut down the container."""
-    cmd = ["podman", "stop", NAME]
+    """Shut down the containers of all servers."""
+    cmd = ["podman", "stop", "--ignore"]
+    cmd += [name(instance) for instance in sllm.pool.instances()]
 
     proc = subprocess.run(cmd, text=True, capture_output=True)
     if proc.returncode > 0:
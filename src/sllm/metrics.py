@@ -0,0 +1,253 @@
+import logging
+import math
+import os
+import pathlib
+import sqlite3
+import time
+
+import sllm.common
+
+
+MAX_ROWS: int = int(os.getenv("SLLM_METRICS_ROWS", "10000"))
+DATABASE: str = "metrics.sqlite"
+PERCENTILES: tuple[int, ...] = (50, 95, 99)
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS requests (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp REAL NOT NULL,
+    model TEXT NOT NULL,
+    input_tokens INTEGER NOT NULL,
+    output_tokens INTEGER NOT NULL,
+    queue REAL NOT NULL,
+    load REAL NOT NULL,
+    prompt_eval REAL NOT NULL,
+    eval REAL NOT NULL,
+    wall_time REAL NOT NULL,
+    time_to_first_token REAL,
+    cache TEXT NOT NULL,
+    outcome TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS requests_timestamp ON requests (timestamp);
+"""
+
+# Durations summarized by 'summarize()', as stored in the database
+DURATIONS: tuple[str, ...] = (
+    "wall_time",
+    "time_to_first_token",
+    "queue",
+    "load",
+    "prompt_eval",
+    "eval",
+)
+
+
+def percentile(values: list[float], p: float) -> float | None:
+    """Compute a percentile using the nearest-rank method.
+
+    :returns: The percentile, or None if there are no values.
+    """
+    if not values:
+        return None
+    ordered: list[float] = sorted(values)
+    rank: int = math.ceil(p / 100 * len(ordered))
+    return ordered[max(rank, 1) - 1]
+
+
+class Store:
+    def __init__(
+        self, path: pathlib.Path | None = None, *, max_rows: int = MAX_ROWS
+    ):
+        """Open the on-disk record of requests.
+
+        Only the newest rows are kept, older ones are rotated out.
+
+        :param path: Database file, defaults to one in the cache directory.
+        :param max_rows: How many requests to keep.
+        """
+        if path is None:
+            path = sllm.common.cache_dir() / DATABASE
+        self.path: pathlib.Path = path
+        self.max_rows: int = max_rows
+        self.db = sqlite3.connect(path, timeout=5, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def add(self, row: dict) -> None:
+        """Record a finished request.
+
+        :param row: Values of the columns, except for 'id'.
+        """
+        columns: list[str] = list(row)
+        cursor = self.db.execute(
+            "INSERT INTO requests ({names}) VALUES ({marks})".format(
+                names=", ".join(columns),
+                marks=", ".join("?" for _ in columns),
+            ),
+            [row[c] for c in columns],
+        )
+        if cursor.lastrowid is not None and cursor.lastrowid % 100 == 0:
+            # Rotating on every insert would be wasteful
+            self.db.execute(
+                "DELETE FROM requests WHERE id <= ?",
+                (cursor.lastrowid - self.max_rows,),
+            )
+
+    def rows(self, since: float) -> list[dict]:
+        """Load requests made after the timestamp."""
+        cursor = self.db.execute(
+            "SELECT * FROM requests WHERE timestamp >= ? "
+            "ORDER BY timestamp ASC",
+            (since,),
+        )
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def record(row: dict) -> None:
+    """Record a finished request, ignoring any storage errors."""
+    row = {"timestamp": time.time(), "model": sllm.common.MODEL, **row}
+    try:
+        store = Store()
+        try:
+            store.add(row)
+        finally:
+            store.close()
+    except sqlite3.Error as exc:
+        logger.debug(f"Cannot record the request: {exc}.")
+
+
+def summarize(rows: list[dict], window: float) -> dict:
+    """Compute percentiles and throughput of requests.
+
+    :param rows: Requests, as returned by 'Store.rows()'.
+    :param window: Length of the time window, in seconds.
+    """
+    answered: list[dict] = [
+        r for r in rows if r["outcome"] == "ok" and r["cache"] != "hit"
+    ]
+    outcomes: dict[str, int] = {}
+    caches: dict[str, int] = {}
+    for row in rows:
+        outcomes[row["outcome"]] = outcomes.get(row["outcome"], 0) + 1
+        caches[row["cache"]] = caches.get(row["cache"], 0) + 1
+
+    durations: dict[str, dict] = {}
+    for name in DURATIONS:
+        values: list[float] = [r[name] for r in answered if r[name] is not None]
+        durations[name] = {f"p{p}": percentile(values, p) for p in PERCENTILES}
+        durations[name]["sum"] = sum(values)
+        durations[name]["count"] = len(values)
+
+    speeds: list[float] = [
+        r["output_tokens"] / r["eval"] for r in answered if r["eval"]
+    ]
+    output_tokens: int = sum(r["output_tokens"] for r in answered)
+    return {
+        "window": window,
+        "requests": len(rows),
+        "outcomes": outcomes,
+        "cache": caches,
+        "input_tokens": sum(r["input_tokens"] for r in answered),
+        "output_tokens": output_tokens,
+        "requests_per_hour": len(rows) / window * 3600 if window else 0.0,
+        "tokens_per_second": {
+            f"p{p}": percentile(speeds, p) for p in PERCENTILES
+        },
+        "durations": durations,
+    }
+
+
+def format_summary(summary: dict) -> list[str]:
+    """Render the summary as lines of text."""
+
+    def number(value: float | None) -> str:
+        return "-" if value is None else f"{value:.2f}"
+
+    hits: int = summary["cache"].get("hit", 0)
+    looked_up: int = hits + summary["cache"].get("miss", 0)
+    lines: list[str] = [
+        "{n} requests ({rate:.1f} per hour), {outcomes}.".format(
+            n=summary["requests"],
+            rate=summary["requests_per_hour"],
+            outcomes=", ".join(
+                f"{count} {outcome}"
+                for outcome, count in sorted(summary["outcomes"].items())
+            )
+            or "none finished",
+        ),
+        "Cache hit rate {rate:.0f} % ({hits} of {total}).".format(
+            rate=100 * hits / looked_up if looked_up else 0.0,
+            hits=hits,
+            total=looked_up,
+        ),
+        "{input} tokens in, {output} tokens out, tokens/s {speed}.".format(
+            input=summary["input_tokens"],
+            output=summary["output_tokens"],
+            speed="/".join(
+                number(summary["tokens_per_second"][f"p{p}"])
+                for p in PERCENTILES
+            ),
+        ),
+    ]
+    for name, values in summary["durations"].items():
+        lines.append(
+            "{name} {values} s".format(
+                name=name.replace("_", " ").capitalize(),
+                values="/".join(number(values[f"p{p}"]) for p in PERCENTILES),
+            )
+        )
+    return lines
+
+
+def write_textfile(path: pathlib.Path, summary: dict) -> None:
+    """Write the summary for the node_exporter textfile collector.
+
+    Values describe the requests in the summarized time window. The file
+    is replaced atomically, so it is never scraped half-written.
+    """
+    model: str = sllm.common.MODEL.replace("\\", "\\\\").replace('"', '\\"')
+    labels: str = f'model="{model}"'
+    lines: list[str] = []
+
+    def metric(name: str, kind: str, help: str) -> None:
+        lines.append(f"# HELP sllm_{name} {help}")
+        lines.append(f"# TYPE sllm_{name} {kind}")
+
+    metric("requests", "gauge", "Requests in the time window.")
+    for outcome, count in sorted(summary["outcomes"].items()):
+        lines.append(f'sllm_requests{{{labels},outcome="{outcome}"}} {count}')
+    metric("cache_requests", "gauge", "Requests by cache result.")
+    for cache, count in sorted(summary["cache"].items()):
+        lines.append(f'sllm_cache_requests{{{labels},cache="{cache}"}} {count}')
+    metric("tokens", "gauge", "Tokens processed in the time window.")
+    lines.append(
+        f'sllm_tokens{{{labels},kind="input"}} {summary["input_tokens"]}'
+    )
+    lines.append(
+        f'sllm_tokens{{{labels},kind="output"}} {summary["output_tokens"]}'
+    )
+
+    for name, values in summary["durations"].items():
+        metric(
+            f"{name}_seconds",
+            "summary",
+            f"Request {name.replace('_', ' ')} in the time window.",
+        )
+        for p in PERCENTILES:
+            value: float | None = values[f"p{p}"]
+            if value is None:
+                continue
+            lines.append(
+                f'sllm_{name}_seconds{{{labels},quantile="{p / 100}"}} {value}'
+            )
+        lines.append(f"sllm_{name}_seconds_sum{{{labels}}} {values['sum']}")
+        lines.append(f"sllm_{name}_seconds_count{{{labels}}} {values['count']}")
+
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text("\n".join(lines) + "\n")
+    tmp.replace(path)
@@ -0,0 +1,163 @@
+"""Pool of servers sharing the requests.
+
+With 'SLLM_INSTANCES' above one, the model is served by several
+containers on consecutive ports, see 'sllm.container'. Each request is
+sent to the healthy server with the fewest requests in flight. When a
+server refuses the connection, it is considered down for a while and
+the request is sent to the next one.
+"""
+
+import contextlib
+import logging
+import pathlib
+import threading
+import time
+from typing import TYPE_CHECKING, Iterator
+
+import sllm.activity
+import sllm.common
+
+if TYPE_CHECKING:
+    import requests
+
+
+# How long a server that refused a connection is avoided, in seconds
+DOWN_TTL: float = 30.0
+
+logger = logging.getLogger(__name__)
+
+# The choice and the in-flight marker have to be made together, or
+# concurrent requests would all pick the same server
+_choice_lock = threading.Lock()
+
+
+def instances() -> range:
+    """List the servers of the pool."""
+    return range(sllm.common.INSTANCES)
+
+
+def _down_marker(instance: int) -> pathlib.Path:
+    return sllm.common.runtime_dir() / f"down-{instance}"
+
+
+def mark_down(instance: int) -> None:
+    """Avoid the server for a while.
+
+    The mark is shared with other processes, so that short-lived ones
+    do not have to find out again.
+    """
+    logger.warning(f"Server {sllm.common.api_url(instance)} is down.")
+    try:
+        _down_marker(instance).touch()
+    except OSError as exc:
+        logger.debug(f"Cannot mark server as down: {exc}.")
+
+
+def mark_up(instance: int) -> None:
+    """Use the server again."""
+    _down_marker(instance).unlink(missing_ok=True)
+
+
+def healthy(instance: int) -> bool:
+    """Determine whether the server has not been down recently."""
+    try:
+        since: float = _down_marker(instance).stat().st_mtime
+    except OSError:
+        return True
+    return time.time() - since > DOWN_TTL
+
+
+def candidates() -> list[int]:
+    """Order the servers by preference.
+
+    Healthy servers come first, the least loaded one first. Servers
+    that are down come last, they may have come back meanwhile.
+    """
+    if sllm.common.INSTANCES == 1:
+        return [0]
+    load: dict[int, int] = {i: sllm.activity.in_flight(i) for i in instances()}
+    return sorted(instances(), key=lambda i: (not healthy(i), load[i], i))
+
+
+def reserve(stack: contextlib.ExitStack, *, exclude: set[int]) -> int:
+    """Pick the least loaded server and mark a request to it as in flight.
+
+    :param stack: The request is in flight until the stack is closed.
+    :param exclude: Servers that have already been tried.
+    :returns: The server.
+    """
+    with _choice_lock:
+        instance: int = next(i for i in candidates() if i not in exclude)
+        stack.enter_context(sllm.activity.request(instance))
+    return instance
+
+
+def refused(exc: "requests.exceptions.RequestException") -> bool:
+    """Determine whether the request failed before it was sent.
+
+    Only then can it be sent to another server. A connection that broke
+    later, e.g. 'Connection aborted', may have delivered the request.
+    """
+    import requests
+    import urllib3.exceptions
+
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    reason: object = exc.args[0] if exc.args else None
+    if isinstance(reason, urllib3.exceptions.MaxRetryError):
+        reason = reason.reason
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+@contextlib.contextmanager
+def post(
+    path: str,
+    payload: dict,
+    *,
+    stream: bool = False,
+    timeout: float | None = None,
+) -> Iterator["requests.Response"]:
+    """Send a request to the least loaded server.
+
+    The request is marked as in flight until the block exits, see
+    'sllm.activity.request()'. Servers that cannot be connected to are
+    skipped. Requests that have already been sent are never repeated.
+
+    :param path: API endpoint, e.g. '/api/chat'.
+    :param payload: JSON body of the request.
+    :param stream: Do not read the response body immediately.
+    :param timeout: Read timeout, defaults to the endpoint's timeout.
+    :raises requests.exceptions.RequestException:
+        No server accepted the request, or it failed.
+    """
+    import requests
+    import sllm.client
+
+    tried: set[int] = set()
+    error: requests.exceptions.ConnectionError | None = None
+    while len(tried) < sllm.common.INSTANCES:
+        with contextlib.ExitStack() as stack:
+            instance: int = reserve(stack, exclude=tried)
+            tried.add(instance)
+
+            try:
+                resp: requests.Response = sllm.client.shared(instance).post(
+                    path, payload, stream=stream, timeout=timeout
+                )
+            except requests.exceptions.ConnectionError as exc:
+                if not refused(exc):
+                    raise
+                logger.debug(f"Cannot connect to server {instance}: {exc}.")
+                error = exc
+                if sllm.common.INSTANCES > 1:
+                    mark_down(instance)
+                continue
+
+            if not healthy(instance):
+                mark_up(instance)
+            with resp:
+                yield resp
+            return
+
+    assert error is not None
+    raise error
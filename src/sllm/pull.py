@@ -0,0 +1,262 @@
+"""Downloading models through the API of the server.
+
+The server streams the progress of every layer of the model. Layers it
+already has are reported as complete right away and are not downloaded
+again; partially downloaded layers are continued where they stopped.
+"""
+
+import concurrent.futures
+import dataclasses
+import json
+import logging
+import time
+from typing import Callable
+
+import sllm.trace
+
+
+# How often the progress of a download is reported, in seconds
+PROGRESS_INTERVAL: float = 2.0
+# How many times an interrupted download is continued
+RESUME_ATTEMPTS: int = 3
+
+logger = logging.getLogger(__name__)
+
+
+def full_name(model: str) -> str:
+    """Add the default tag to the name of the model, if it has none."""
+    if ":" in model.rsplit("/", 1)[-1]:
+        return model
+    return f"{model}:latest"
+
+
+def installed(*, instance: int = 0) -> dict[str, str] | None:
+    """List the models the server has.
+
+    :param instance: Server of the pool to ask, see 'sllm.pool'.
+    :returns: Digests of the models by their names, or None if the server
+        is not running.
+    """
+    import requests
+    import sllm.client
+
+    try:
+        resp = sllm.client.shared(instance).get("/api/tags")
+        resp.raise_for_status()
+        models: list[dict] = resp.json().get("models") or []
+    except (requests.exceptions.RequestException, ValueError) as exc:
+        logger.debug(f"Cannot list models: {exc}.")
+        return None
+    return {model["name"]: model.get("digest", "") for model in models}
+
+
+@dataclasses.dataclass
+class Progress:
+    """State of a download, as streamed by the server."""
+
+    model: str
+    status: str = ""
+    # Bytes of each layer: when first seen, completed, and in total
+    layers: dict[str, list[int]] = dataclasses.field(default_factory=dict)
+    finished: bool = False
+
+    @property
+    def completed(self) -> int:
+        return sum(completed for _, completed, _ in self.layers.values())
+
+    @property
+    def total(self) -> int:
+        return sum(total for _, _, total in self.layers.values())
+
+    @property
+    def transferred(self) -> int:
+        """Bytes downloaded, not counting layers the server already had."""
+        return sum(
+            completed - first for first, completed, _ in self.layers.values()
+        )
+
+    def update(self, chunk: dict) -> None:
+        """Process one line of the streamed response.
+
+        :raises RuntimeError: The server reported an error.
+        """
+        if "error" in chunk:
+            raise RuntimeError(
+                f"Couldn't pull model '{self.model}': {chunk['error']}"
+            )
+        self.status = chunk.get("status", self.status)
+        digest: str | None = chunk.get("digest")
+        if digest and "total" in chunk:
+            completed: int = chunk.get("completed", 0)
+            layer: list[int] = self.layers.setdefault(digest, [completed, 0, 0])
+            # What the server had before, even if the download continues
+            layer[0] = min(layer[0], completed)
+            layer[1] = completed
+            layer[2] = chunk["total"]
+        if self.status == "success":
+            self.finished = True
+
+    def describe(self) -> str:
+        if not self.total:
+            return f"Model '{self.model}': {self.status}."
+        return "Model '{model}': {status}, {percent:.0f} % of {size}.".format(
+            model=self.model,
+            status=self.status,
+            percent=100 * self.completed / self.total,
+            size=_size(self.total),
+        )
+
+
+def _size(size: int) -> str:
+    if size >= 2**30:
+        return f"{size / 2**30:.1f} GB"
+    return f"{size / 2**20:.0f} MB"
+
+
+def _stream(
+    progress: Progress, instance: int, report: Callable[[Progress], None]
+) -> None:
+    import sllm.client
+
+    with sllm.client.shared(instance).post(
+        "/api/pull", {"model": progress.model, "stream": True}, stream=True
+    ) as resp:
+        for line in resp.iter_lines():
+            if line:
+                progress.update(json.loads(line))
+                report(progress)
+
+
+def _verify(progress: Progress, digest: str | None) -> None:
+    """Check that the download has completed.
+
+    The server checks the digest of every layer before it writes the
+    manifest. This checks that it got that far, with every layer
+    complete, and that it lists the model afterwards.
+
+    :raises RuntimeError: The download did not complete.
+    """
+    if not progress.finished:
+        raise RuntimeError(
+            f"Couldn't pull model '{progress.model}': the server stopped "
+            f"at '{progress.status}'."
+        )
+    incomplete: list[str] = [
+        digest
+        for digest, (_, completed, total) in progress.layers.items()
+        if completed != total
+    ]
+    if incomplete:
+        raise RuntimeError(
+            f"Couldn't pull model '{progress.model}': layers "
+            f"{', '.join(incomplete)} are incomplete."
+        )
+    if not digest:
+        raise RuntimeError(
+            f"Couldn't pull model '{progress.model}': the server does not "
+            "list it."
+        )
+
+
+def pull(
+    model: str,
+    *,
+    instance: int = 0,
+    report: Callable[[Progress], None] | None = None,
+) -> str:
+    """Download the model, or the parts of it that changed.
+
+    Interrupted downloads are continued, up to 'RESUME_ATTEMPTS' times.
+
+    :param model: Name of the model, e.g. 'llama3.2:3b'.
+    :param instance: Server of the pool to download through. Only the
+        first one can write the models.
+    :param report: Called with the progress after every update.
+    :returns: Digest of the model.
+    :raises RuntimeError: The model could not be downloaded.
+    """
+    import requests
+
+    model = full_name(model)
+    before: str | None = (installed(instance=instance) or {}).get(model)
+    progress = Progress(model)
+    with sllm.trace.span("pull_model"):
+        for attempt in range(1, RESUME_ATTEMPTS + 1):
+            try:
+                _stream(progress, instance, report or (lambda _: None))
+                break
+            except requests.exceptions.RequestException as exc:
+                if attempt == RESUME_ATTEMPTS:
+                    raise RuntimeError(
+                        f"Couldn't pull model '{model}': {exc}"
+                    ) from exc
+                logger.warning(
+                    f"Download of '{model}' has been interrupted, "
+                    f"continuing: {exc}"
+                )
+                time.sleep(attempt)
+
+    after: str | None = (installed(instance=instance) or {}).get(model)
+    _verify(progress, after)
+    assert after is not None
+    if after == before:
+        logger.info(f"Model '{model}' is up to date.")
+    else:
+        logger.info(
+            "Model '{model}' has been downloaded "
+            "({size}, digest {digest}).".format(
+                model=model,
+                size=_size(progress.transferred),
+                digest=after[:12],
+            )
+        )
+    return after
+
+
+def pull_all(
+    models: list[str], *, update: bool = False, instance: int = 0
+) -> dict[str, str]:
+    """Download the models at the same time.
+
+    The progress is logged every 'PROGRESS_INTERVAL' seconds.
+
+    :param models: Names of the models.
+    :param update: Download newer versions of models the server has.
+    :param instance: Server of the pool to download through.
+    :returns: Digests of the models that have been downloaded.
+    :raises RuntimeError: Some of the models could not be downloaded.
+    """
+    present: dict[str, str] = installed(instance=instance) or {}
+    wanted: list[str] = [
+        model
+        for model in dict.fromkeys(full_name(model) for model in models)
+        if update or model not in present
+    ]
+    if not wanted:
+        return {}
+
+    reported: dict[str, float] = {}
+
+    def report(progress: Progress) -> None:
+        now: float = time.monotonic()
+        if now - reported.get(progress.model, 0.0) >= PROGRESS_INTERVAL:
+            reported[progress.model] = now
+            logger.info(progress.describe())
+
+    logger.info(f"Downloading {', '.join(wanted)}.")
+    digests: dict[str, str] = {}
+    errors: list[str] = []
+    with concurrent.futures.ThreadPoolExecutor(len(wanted)) as pool:
+        futures = {
+            model: pool.submit(pull, model, instance=instance, report=report)
+            for model in wanted
+        }
+        for model, future in futures.items():
+            try:
+                digests[model] = future.result()
+            except RuntimeError as exc:
+                logger.error(str(exc))
+                errors.append(model)
+    if errors:
+        raise RuntimeError(f"Couldn't pull {', '.join(errors)}.")
+    return digests
@@ -0,0 +1,197 @@
+import json
+import logging
+import os
+import time
+
+import sllm.common
+import sllm.pool
+import sllm.trace
+import sllm.tuning
+
+
+READY_TTL: int = int(os.getenv("SLLM_READY_TTL", "300"))
+STATE_FILE: str = "ready.json"
+
+logger = logging.getLogger(__name__)
+
+
+def find_model(models: list[dict]) -> dict | None:
+    """Find the configured model in the API model listing.
+
+    :param models: Content of 'models' from '/api/tags'.
+    :returns: The model description, if present.
+    """
+    for model in models:
+        if sllm.common.MODEL in model.get("name", ""):
+            return model
+    return None
+
+
+@sllm.trace.traced("probe")
+def probe() -> dict | None:
+    """Check that the API is up and the model is available.
+
+    This does not run any inference, it only lists the models known to
+    the server. Whether the model is loaded into memory does not matter,
+    the server loads it for the first request; 'sllm --status' shows it.
+    With a pool of servers, the first one that responds is asked, they
+    share the models.
+
+    :returns: Description of the model, or None if it is not available.
+    """
+    import requests
+    import sllm.client
+
+    for instance in sllm.pool.candidates():
+        client: sllm.client.Client = sllm.client.shared(instance)
+        try:
+            resp = client.get("/api/tags")
+            break
+        except requests.exceptions.RequestException as exc:
+            logger.debug(
+                f"HTTP API at {client.base_url} is not running: {exc}."
+            )
+    else:
+        return None
+    if not resp.ok:
+        logger.debug(f"HTTP API is not well: {resp}.")
+        return None
+
+    model: dict | None = find_model(resp.json().get("models") or [])
+    if model is None:
+        logger.debug(f"Model '{sllm.common.MODEL}' is not present.")
+        return None
+    return model
+
+
+@sllm.trace.traced("canary")
+def canary() -> bool:
+    """Ask the model a trivial question.
+
+    Models can go crazy when their runtime misconfigures them.
+    This should be good enough indicator to determine whether the
+    model is good or not.
+
+    :returns: True if the model is able to respond.
+    """
+    import requests
+
+    logger.debug("Sending health/sanity check request.")
+
+    try:
+        with sllm.pool.post(
+            "/api/chat",
+            {
+                "model": sllm.common.MODEL,
+                "stream": False,
+                "keep_alive": sllm.common.keep_alive(),
+                # Same context as most requests, so the model is not
+                # reloaded for them
+                "options": {
+                    "temperature": 0.0,
+                    "num_ctx": sllm.common.CONTEXT,
+                    "num_predict": 8,
+                    **sllm.tuning.options(),
+                },
+                "messages": [
+                    {
+                        "role": "user",
+                        "content": "Reply with the string 'pong'.",
+                    }
+                ],
+            },
+            timeout=5,
+        ) as req:
+            response: dict = req.json()
+    except requests.exceptions.Timeout:
+        logger.error("Model didn't respond on time.")
+        return False
+
+    pong: str = response["message"]["content"].strip()
+    if pong != "pong":
+        logger.error(
+            f"Model didn't respond properly: wanted 'pong', got '{pong}'."
+        )
+        return False
+
+    logger.debug("Model seems to be sane and healthy.")
+    return True
+
+
+def load_state() -> dict | None:
+    """Load the last known good state.
+
+    :returns: The state, or None if there is none.
+    """
+    path = sllm.common.runtime_dir() / STATE_FILE
+    try:
+        state: dict = json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
+    return state
+
+
+def save_state(model: dict) -> None:
+    """Remember that the model has been verified to work.
+
+    :param model: Description of the model, as returned by 'probe()'.
+    """
+    path = sllm.common.runtime_dir() / STATE_FILE
+    state: dict = {
+        "model": sllm.common.MODEL,
+        "digest": model.get("digest", ""),
+        "timestamp": time.time(),
+    }
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(state))
+    tmp.replace(path)
+
+
+def invalidate() -> None:
+    """Forget the last known good state.
+
+    Should be called whenever the server is (re)started.
+    """
+    path = sllm.common.runtime_dir() / STATE_FILE
+    path.unlink(missing_ok=True)
+    logger.debug("Readiness state has been invalidated.")
+
+
+@sllm.trace.traced("ready")
+def ready(*, deep: bool = False) -> bool:
+    """Determine whether the model can serve requests.
+
+    Recently verified state is trusted without any network traffic.
+    Once it expires, the server is probed for the model. The model is
+    only asked a question after the server restarts, after the model
+    changes, or if explicitly requested.
+
+    :param deep: Always ask the model a question.
+    :returns: True if the model is ready.
+    """
+    state: dict | None = load_state()
+    if (
+        not deep
+        and state is not None
+        and state.get("model") == sllm.common.MODEL
+        and time.time() - state.get("timestamp", 0) < READY_TTL
+    ):
+        logger.debug("Model has been verified recently.")
+        return True
+
+    model: dict | None = probe()
+    if model is None:
+        return False
+
+    known: bool = (
+        state is not None
+        and state.get("model") == sllm.common.MODEL
+        and state.get("digest") == model.get("digest", "")
+    )
+    if deep or not known:
+        if not canary():
+            invalidate()
+            return False
+
+    save_state(model)
+    return True
@@ -0,0 +1,189 @@
+import contextlib
+import dataclasses
+import functools
+import itertools
+import json
+import logging
+import os
+import pathlib
+import sys
+import threading
+import time
+from typing import Callable, Iterator, ParamSpec, TypeVar
+
+
+TRACE_FILE: str = os.getenv("SLLM_TRACE", "")
+
+logger = logging.getLogger(__name__)
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+_ids = itertools.count()
+
+
+@dataclasses.dataclass
+class Span:
+    """Single timed phase of the program."""
+
+    name: str
+    start: float
+    duration: float = 0.0
+    depth: int = 0
+    parent: int | None = None
+    attributes: dict = dataclasses.field(default_factory=dict)
+    id: int = dataclasses.field(default_factory=lambda: next(_ids))
+
+
+_enabled: bool = TRACE_FILE != ""
+_spans: list[Span] = []
+_lock = threading.Lock()
+_local = threading.local()
+# Groups the records of a single invocation in the trace file
+_invocation: str = os.urandom(8).hex()
+
+
+def enable() -> None:
+    """Collect spans even if they are not written to a trace file."""
+    global _enabled
+    _enabled = True
+
+
+def _stack() -> list[Span]:
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    stack: list[Span] = _local.stack
+    return stack
+
+
+def _write(span: Span) -> None:
+    if not TRACE_FILE:
+        return
+    record: dict = {
+        "invocation": _invocation,
+        "program": pathlib.Path(sys.argv[0]).name,
+        "pid": os.getpid(),
+        "name": span.name,
+        "start": span.start,
+        "duration": span.duration,
+        "id": span.id,
+        "parent": span.parent,
+        **span.attributes,
+    }
+    try:
+        with open(TRACE_FILE, "a") as handle:
+            handle.write(json.dumps(record) + "\n")
+    except OSError as exc:
+        logger.debug(f"Cannot write trace record: {exc}.")
+
+
+def _add(span: Span) -> None:
+    with _lock:
+        _spans.append(span)
+        _write(span)
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes: object) -> Iterator[None]:
+    """Measure how long a phase takes.
+
+    Spans can be nested. They are only collected when enabled, either by
+    '--timings' or by setting $SLLM_TRACE to a file to append them to.
+
+    :param name: Name of the phase.
+    :param attributes: Additional information to store with the span.
+    """
+    if not _enabled:
+        yield
+        return
+
+    stack: list[Span] = _stack()
+    current = Span(
+        name,
+        time.time(),
+        depth=len(stack),
+        parent=stack[-1].id if stack else None,
+        attributes=attributes,
+    )
+    stack.append(current)
+    begin: float = time.monotonic()
+    try:
+        yield
+    finally:
+        current.duration = time.monotonic() - begin
+        stack.pop()
+        _add(current)
+
+
+def traced(name: str) -> Callable[[Callable[P, R]], Callable[P, R]]:
+    """Measure every call of the function as a span."""
+
+    def decorator(function: Callable[P, R]) -> Callable[P, R]:
+        @functools.wraps(function)
+        def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+            with span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record(
+    name: str,
+    duration: float,
+    *,
+    start: float | None = None,
+    **attributes: object,
+) -> None:
+    """Add a phase that has been measured elsewhere, e.g. by the server.
+
+    It is placed under the current span.
+
+    :param duration: Duration of the phase, in seconds.
+    :param start: UNIX timestamp of the start, defaults to just now.
+    """
+    if not _enabled:
+        return
+    if start is None:
+        start = time.time() - duration
+    stack: list[Span] = _stack()
+    _add(
+        Span(
+            name,
+            start,
+            duration,
+            depth=len(stack),
+            parent=stack[-1].id if stack else None,
+            attributes=attributes,
+        )
+    )
+
+
+def report() -> str:
+    """Describe collected spans as a tree, in the order they started."""
+    with _lock:
+        spans: list[Span] = sorted(_spans, key=lambda s: s.start)
+    children: dict[int | None, list[Span]] = {}
+    for item in spans:
+        children.setdefault(item.parent, []).append(item)
+
+    ordered: list[Span] = []
+
+    def visit(parent: int | None) -> None:
+        for child in children.get(parent, []):
+            ordered.append(child)
+            visit(child.id)
+
+    visit(None)
+    lines: list[str] = []
+    for item in ordered:
+        lines.append(
+            "{indent}{name:<{width}} {duration:8.3f} s".format(
+                indent="  " * item.depth,
+                name=item.name,
+                width=30 - 2 * item.depth,
+                duration=item.duration,
+            )
+        )
+    return "\n".join(lines)
@@ -0,0 +1,312 @@
+import dataclasses
+import functools
+import logging
+import os
+import pathlib
+from typing import Callable
+
+import sllm.common
+
+
+# Overrides the location of the tuning file
+CONFIG_FILE: str = os.getenv("SLLM_TUNING", "")
+# Settings, in the order they are shown
+SETTINGS: tuple[str, ...] = (
+    "cpuset_cpus",
+    "cpus",
+    "memory",
+    "threads",
+    "OLLAMA_NUM_PARALLEL",
+    "OLLAMA_MAX_LOADED_MODELS",
+    "OLLAMA_FLASH_ATTENTION",
+    "OLLAMA_KV_CACHE_TYPE",
+)
+# Below this much memory, the KV cache is quantized
+SMALL_MEMORY: int = 16 * 2**30
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class Host:
+    """Resources of the machine, as far as this process can use them."""
+
+    cpus: list[int]
+    # CPUs of each NUMA node
+    nodes: list[list[int]]
+    # CPUs sharing a physical core, by the CPU
+    siblings: dict[int, frozenset[int]]
+    memory: int
+
+    def cores(self, cpus: list[int]) -> int:
+        """Count the physical cores the CPUs belong to."""
+        return len({self.siblings.get(cpu, frozenset([cpu])) for cpu in cpus})
+
+
+@dataclasses.dataclass
+class Profile:
+    """Settings of the container, and where they come from."""
+
+    host: Host
+    settings: dict[str, str]
+    overridden: list[str]
+    config: pathlib.Path
+
+
+def parse_cpus(text: str) -> list[int]:
+    """Parse a list of CPUs, e.g. '0-3,8'."""
+    cpus: list[int] = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus += range(int(first), int(last or first) + 1)
+    return cpus
+
+
+def format_cpus(cpus: list[int]) -> str:
+    """Format a list of CPUs, e.g. '0-3,8'."""
+    ranges: list[list[int]] = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(
+        str(first) if first == last else f"{first}-{last}"
+        for first, last in ranges
+    )
+
+
+def _read(path: pathlib.Path) -> str:
+    try:
+        return path.read_text()
+    except OSError:
+        return ""
+
+
+def detect() -> Host:
+    """Find out the CPUs, NUMA nodes and memory of the machine."""
+    cpus: list[int] = sorted(os.sched_getaffinity(0))
+
+    nodes: list[list[int]] = []
+    for path in sorted(pathlib.Path("/sys/devices/system/node").glob("node*")):
+        node: list[int] = [
+            cpu for cpu in parse_cpus(_read(path / "cpulist")) if cpu in cpus
+        ]
+        if node:
+            nodes.append(node)
+
+    siblings: dict[int, frozenset[int]] = {}
+    for cpu in cpus:
+        path = pathlib.Path(
+            f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list"
+        )
+        siblings[cpu] = frozenset(parse_cpus(_read(path)) or [cpu])
+
+    memory: int = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    return Host(cpus, nodes or [cpus], siblings, memory)
+
+
+def _cores(host: Host, cpus: list[int]) -> list[tuple[int, ...]]:
+    """Group the CPUs by physical cores, ordered by NUMA nodes."""
+    node: dict[int, int] = {
+        cpu: index
+        for index, members in enumerate(host.nodes)
+        for cpu in members
+    }
+    return sorted(
+        {
+            tuple(sorted(host.siblings.get(cpu, frozenset([cpu])) & set(cpus)))
+            for cpu in cpus
+        },
+        key=lambda core: (node.get(core[0], 0), core[0]),
+    )
+
+
+def split(host: Host, cpus: list[int], parts: int) -> list[list[int]]:
+    """Split the CPUs into sets of whole physical cores, one per server.
+
+    Hyper-threads of a core stay together, and cores are taken node by
+    node, so that the sets do not span NUMA nodes when they fit into one.
+    When there are fewer cores than servers, servers share them.
+    """
+    cores: list[tuple[int, ...]] = _cores(host, cpus)
+    size: int = max(len(cores) // parts, 1)
+    sets: list[list[int]] = []
+    for part in range(parts):
+        first: int = part * size % len(cores)
+        sets.append(
+            [cpu for core in cores[first : first + size] for cpu in core]
+        )
+    return sets
+
+
+def _threads(host: Host, cpus: list[int], limit: float) -> str:
+    # One thread per physical core, hyper-threads slow inference down
+    return str(max(min(host.cores(cpus), int(limit)), 1))
+
+
+def defaults(host: Host) -> dict[str, str]:
+    """Derive the settings from the resources of the machine.
+
+    Empty values leave the setting to podman or ollama. With a pool of
+    servers, the settings apply to each server: the CPUs are split
+    between them, see 'split()', and so is the memory.
+    """
+    settings: dict[str, str] = dict.fromkeys(SETTINGS, "")
+    cpus: list[int] = host.cpus
+    limit: int = len(cpus)
+    if sllm.common.INSTANCES > 1:
+        # Each server gets its own cores, the rest of the system gets
+        # a quarter of them
+        cores: list[tuple[int, ...]] = _cores(host, cpus)
+        keep: int = max(len(cores) - len(cores) // 4, sllm.common.INSTANCES)
+        cpus = [cpu for core in cores[:keep] for cpu in core]
+        settings["cpuset_cpus"] = format_cpus(cpus)
+        cpus = split(host, cpus, sllm.common.INSTANCES)[0]
+        limit = len(cpus)
+    elif len(host.nodes) > 1:
+        # Memory of other nodes is slow, keep the model on the largest one
+        cpus = max(host.nodes, key=len)
+        settings["cpuset_cpus"] = format_cpus(cpus)
+        limit = len(cpus)
+    elif limit >= 4:
+        # Leave a quarter of the machine to the rest of the system
+        limit -= limit // 4
+        settings["cpus"] = str(limit)
+
+    settings["threads"] = _threads(host, cpus, limit)
+    memory: int = host.memory * 3 // 4 // sllm.common.INSTANCES
+    settings["memory"] = f"{memory // 2**20}m"
+    settings["OLLAMA_NUM_PARALLEL"] = str(sllm.common.PARALLEL)
+    # sllm uses a single model
+    settings["OLLAMA_MAX_LOADED_MODELS"] = "1"
+    # Needed by the quantized KV cache, and faster on its own
+    settings["OLLAMA_FLASH_ATTENTION"] = "1"
+    settings["OLLAMA_KV_CACHE_TYPE"] = (
+        "q8_0" if host.memory < SMALL_MEMORY else "f16"
+    )
+    return settings
+
+
+def config_path() -> pathlib.Path:
+    """Get the location of the tuning file."""
+    if CONFIG_FILE:
+        return pathlib.Path(CONFIG_FILE)
+    base: str = os.getenv("XDG_CONFIG_HOME") or str(
+        pathlib.Path.home() / ".config"
+    )
+    return pathlib.Path(base) / "sllm" / "tuning.conf"
+
+
+def load_config(path: pathlib.Path) -> dict[str, str]:
+    """Load the overrides from the tuning file.
+
+    The file contains 'NAME=VALUE' lines, with names from 'SETTINGS'.
+    Lines starting with '#' are ignored. An empty value unsets the
+    setting.
+
+    :returns: The overrides, or nothing if the file does not exist.
+    :raises ValueError: The file is not valid.
+    """
+    try:
+        lines: list[str] = path.read_text().splitlines()
+    except FileNotFoundError:
+        return {}
+
+    overrides: dict[str, str] = {}
+    for number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        name, equals, value = line.partition("=")
+        name = name.strip()
+        if not equals or name not in SETTINGS:
+            raise ValueError(f"Invalid setting in {path}:{number}: '{line}'.")
+        overrides[name] = value.strip()
+
+    checks: dict[str, Callable[[str], object]] = {
+        "cpuset_cpus": parse_cpus,
+        "cpus": float,
+        "threads": int,
+    }
+    for name, check in checks.items():
+        if overrides.get(name):
+            try:
+                check(overrides[name])
+            except ValueError:
+                raise ValueError(
+                    f"Invalid value of {name} in {path}: '{overrides[name]}'."
+                ) from None
+    return overrides
+
+
+@functools.cache
+def profile() -> Profile:
+    """Compute the settings of the container.
+
+    :raises ValueError: The tuning file is not valid.
+    """
+    host: Host = detect()
+    path: pathlib.Path = config_path()
+    overrides: dict[str, str] = load_config(path)
+    settings: dict[str, str] = {**defaults(host), **overrides}
+    if "threads" not in overrides and {"cpus", "cpuset_cpus"} & set(overrides):
+        # Follow the CPUs set by the user
+        cpus: list[int] = parse_cpus(settings["cpuset_cpus"]) or host.cpus
+        if sllm.common.INSTANCES > 1:
+            cpus = split(host, cpus, sllm.common.INSTANCES)[0]
+        limit: float = float(settings["cpus"] or len(cpus))
+        settings["threads"] = _threads(host, cpus, limit)
+    logger.debug(f"Tuning: {settings}.")
+    return Profile(host, settings, list(overrides), path)
+
+
+def podman_args(instance: int = 0) -> list[str]:
+    """Arguments of 'podman run' applying the settings.
+
+    :param instance: Server of the pool, it gets its share of the CPUs.
+    """
+    settings: dict[str, str] = dict(profile().settings)
+    if sllm.common.INSTANCES > 1:
+        host: Host = profile().host
+        cpus: list[int] = parse_cpus(settings["cpuset_cpus"]) or host.cpus
+        shares: list[list[int]] = split(host, cpus, sllm.common.INSTANCES)
+        settings["cpuset_cpus"] = format_cpus(shares[instance])
+    args: list[str] = []
+    for name, flag in (
+        ("cpuset_cpus", "--cpuset-cpus"),
+        ("cpus", "--cpus"),
+        ("memory", "--memory"),
+    ):
+        if settings[name]:
+            args += [flag, settings[name]]
+    for name, value in settings.items():
+        if name.startswith("OLLAMA_") and value:
+            args += ["--env", f"{name}={value}"]
+    return args
+
+
+@functools.cache
+def _fallback(error: str) -> dict[str, str]:
+    logger.warning(f"{error} Using the detected settings.")
+    return defaults(detect())
+
+
+def options() -> dict:
+    """Model options applying the settings.
+
+    They have to be sent with every request. The server reloads the
+    model when they differ from the ones it has been loaded with.
+
+    An invalid tuning file does not fail the request, the detected
+    settings are used instead. 'sllm --start' and 'sllm --status'
+    report the error.
+    """
+    try:
+        settings: dict[str, str] = profile().settings
+    except ValueError as exc:
+        settings = _fallback(str(exc))
+    threads: str = settings["threads"]
+    return {"num_thread": int(threads)} if threads else {}
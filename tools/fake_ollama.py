@@ -0,0 +1,419 @@
+"""Stand-in for the ollama server, for testing without a model.
+
+It implements the endpoints sllm uses. Responses are generated at
+a configurable speed, with configurable latency, failures and number
+of parallel slots, so the client can be measured and tested on machines
+without a model or network access.
+
+    $ python tools/fake_ollama.py --tokens-per-second 50 --parallel 2
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import sllm.common
+
+
+VERSION: str = "0.0.0-fake"
+DIGEST: str = hashlib.sha256(b"fake").hexdigest()
+SIZE: int = 2 * 2**30
+# Size of the layer downloaded by '/api/pull', and of its steps
+LAYER_SIZE: int = 4 * 2**20
+STEP: int = 2**20
+
+REVIEW: str = (
+    "1. Title: The title matches the message.\n"
+    "2. What: The change is described well.\n"
+    "3. Why: Meh, I do not know."
+)
+
+
+class Model:
+    def __init__(self, args: argparse.Namespace):
+        """State of the fake model, shared by all requests."""
+        self.args = args
+        self.slots = threading.BoundedSemaphore(args.parallel)
+        self.lock = threading.Lock()
+        self.waiting: int = 0
+        self.loaded_until: float = 0.0
+        self.random = random.Random(args.seed)
+        # Bytes of the layer downloaded, by the model; the configured
+        # model is present from the start
+        self.pulled: dict[str, int] = {sllm.common.MODEL: LAYER_SIZE}
+        self.interrupted: set[str] = set()
+
+    def load(self, keep_alive: float) -> float:
+        """Load the model, if needed.
+
+        :returns: Time spent loading, in seconds.
+        """
+        with self.lock:
+            loaded: bool = self.loaded_until > time.time()
+            self.loaded_until = time.time() + keep_alive
+        if loaded:
+            return 0.0
+        time.sleep(self.args.load_time)
+        return float(self.args.load_time)
+
+    def unload(self) -> None:
+        with self.lock:
+            self.loaded_until = 0.0
+
+    def fails(self) -> bool:
+        with self.lock:
+            failed: bool = self.random.random() < self.args.failure_rate
+        return failed
+
+
+def _digest(model: str) -> str:
+    if model == sllm.common.MODEL:
+        return DIGEST
+    return hashlib.sha256(model.encode()).hexdigest()
+
+
+def _keep_alive(payload: dict) -> float:
+    value = payload.get("keep_alive", 300)
+    if isinstance(value, str):
+        return float(sllm.common.parse_interval(value))
+    return float(value)
+
+
+def _answer(payload: dict, tokens: int) -> tuple[list[str], str]:
+    """Make up the answer, honoring 'num_predict' and 'stop'.
+
+    :returns: Chunks of the answer and the reason it ended.
+    """
+    messages: list[dict] = payload.get("messages") or []
+    question: str = messages[-1].get("content", "") if messages else ""
+    if "pong" in question:
+        return ["pong"], "stop"
+    options: dict = payload.get("options") or {}
+    limit: int = options.get("num_predict", -1)
+    stops: list[str] = options.get("stop") or []
+
+    words: list[str] = REVIEW.replace("\n", " \n ").split(" ")
+    chunks: list[str] = []
+    for i in range(tokens):
+        if 0 <= limit <= i:
+            return chunks, "length"
+        word: str = words[i % len(words)]
+        glued: bool = i == 0 or word == "\n" or chunks[-1] == "\n"
+        chunks.append(word if glued else " " + word)
+        text: str = "".join(chunks)
+        for stop in stops:
+            index: int = text.find(stop)
+            if index < 0:
+                continue
+            # Drop the stop sequence and anything after it
+            while len("".join(chunks)) > index:
+                last: str = chunks.pop()
+            chunks.append(last[: index - len("".join(chunks))])
+            return chunks, "stop"
+    return chunks, "stop"
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    model: Model
+
+    def log_message(self, format: str, *args: object) -> None:
+        if self.model.args.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, content: dict, status: int = 200) -> None:
+        body: bytes = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_stream(self) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _send_chunk(self, content: dict) -> None:
+        data: bytes = (json.dumps(content) + "\n").encode()
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _end_stream(self) -> None:
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _payload(self) -> dict:
+        length: int = int(self.headers.get("Content-Length", 0))
+        if not length:
+            return {}
+        payload: dict = json.loads(self.rfile.read(length))
+        return payload
+
+    def _model_info(self, model: str = sllm.common.MODEL) -> dict:
+        return {
+            "name": model,
+            "model": model,
+            "digest": _digest(model),
+            "size": SIZE,
+            "details": {"quantization_level": "Q4_K_M"},
+        }
+
+    def do_GET(self) -> None:
+        if self.path == "/":
+            body: bytes = b"Ollama is running"
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == "/api/version":
+            self._send_json({"version": VERSION})
+        elif self.path == "/api/tags":
+            with self.model.lock:
+                present: list[str] = [
+                    model
+                    for model, pulled in self.model.pulled.items()
+                    if pulled == LAYER_SIZE
+                ]
+            self._send_json(
+                {"models": [self._model_info(model) for model in present]}
+            )
+        elif self.path == "/api/ps":
+            models: list[dict] = []
+            if self.model.loaded_until > time.time():
+                until = datetime.datetime.fromtimestamp(
+                    self.model.loaded_until, tz=datetime.timezone.utc
+                )
+                models.append(
+                    {
+                        **self._model_info(),
+                        "size_vram": 0,
+                        "expires_at": until.isoformat(),
+                    }
+                )
+            self._send_json({"models": models})
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def do_POST(self) -> None:
+        payload: dict = self._payload()
+        if self.path == "/api/chat":
+            self._chat(payload)
+        elif self.path == "/api/pull":
+            self._pull(payload)
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def _chat(self, payload: dict) -> None:
+        args: argparse.Namespace = self.model.args
+        if not payload.get("messages"):
+            # Loading or unloading the model, without any inference
+            keep_alive: float = _keep_alive(payload)
+            if keep_alive == 0:
+                self.model.unload()
+            else:
+                self.model.load(keep_alive)
+            self._send_json(
+                {"model": sllm.common.MODEL, "done": True, "message": {}}
+            )
+            return
+
+        with self.model.lock:
+            if self.model.waiting >= args.parallel + args.max_queue:
+                busy: bool = True
+            else:
+                busy = False
+                self.model.waiting += 1
+        if busy:
+            self._send_json({"error": "server busy, please try again"}, 503)
+            return
+
+        try:
+            with self.model.slots:
+                self._generate(payload)
+        finally:
+            with self.model.lock:
+                self.model.waiting -= 1
+
+    def _generate(self, payload: dict) -> None:
+        args: argparse.Namespace = self.model.args
+        start: float = time.monotonic()
+        load: float = self.model.load(_keep_alive(payload))
+        if self.model.fails():
+            self._send_json({"error": "model runner has crashed"}, 500)
+            return
+
+        prompt: int = sum(
+            len(m.get("content", "")) for m in payload.get("messages", [])
+        )
+        prompt_tokens: int = prompt // 4 + 1
+        time.sleep(args.latency)
+        prompt_time: float = args.latency
+
+        chunks, reason = _answer(payload, args.tokens)
+        eval_start: float = time.monotonic()
+        stream: bool = payload.get("stream", True)
+        if stream:
+            self._start_stream()
+        for chunk in chunks:
+            time.sleep(1 / args.tokens_per_second)
+            if stream:
+                self._send_chunk(
+                    {
+                        "model": sllm.common.MODEL,
+                        "message": {"role": "assistant", "content": chunk},
+                        "done": False,
+                    }
+                )
+        eval_time: float = time.monotonic() - eval_start
+
+        final: dict = {
+            "model": sllm.common.MODEL,
+            "message": {
+                "role": "assistant",
+                "content": "" if stream else "".join(chunks),
+            },
+            "done": True,
+            "done_reason": reason,
+            "total_duration": int((time.monotonic() - start) * 10**9),
+            "load_duration": int(load * 10**9),
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(prompt_time * 10**9),
+            "eval_count": len(chunks),
+            "eval_duration": int(eval_time * 10**9),
+        }
+        if stream:
+            self._send_chunk(final)
+            self._end_stream()
+        else:
+            self._send_json(final)
+
+    def _pull(self, payload: dict) -> None:
+        """Download the model, continuing where the last download stopped.
+
+        Models with 'missing' in their name do not exist. With
+        '--interrupt-pull', the first download of every model breaks off
+        in the middle.
+        """
+        model: str = payload.get("model") or payload.get("name", "")
+        stream: bool = payload.get("stream", True)
+        if "missing" in model:
+            error: dict = {"error": "pull model manifest: file does not exist"}
+            if not stream:
+                self._send_json(error, 500)
+                return
+            self._start_stream()
+            self._send_chunk({"status": "pulling manifest"})
+            self._send_chunk(error)
+            self._end_stream()
+            return
+
+        with self.model.lock:
+            start: int = self.model.pulled.setdefault(model, 0)
+            interrupt: bool = (
+                self.model.args.interrupt_pull
+                and start < LAYER_SIZE
+                and model not in self.model.interrupted
+            )
+            self.model.interrupted.add(model)
+
+        digest: str = _digest(model)
+        if stream:
+            self._start_stream()
+            self._send_chunk({"status": "pulling manifest"})
+        for completed in range(start, LAYER_SIZE + 1, STEP):
+            time.sleep(self.model.args.latency / (LAYER_SIZE // STEP))
+            with self.model.lock:
+                self.model.pulled[model] = completed
+            if interrupt and completed >= LAYER_SIZE // 2:
+                # Drop the connection without ending the stream
+                self.close_connection = True
+                return
+            if stream:
+                self._send_chunk(
+                    {
+                        "status": f"pulling {digest[:12]}",
+                        "digest": f"sha256:{digest}",
+                        "total": LAYER_SIZE,
+                        "completed": completed,
+                    }
+                )
+        if not stream:
+            self._send_json({"status": "success"})
+            return
+        for status in (
+            "verifying sha256 digest",
+            "writing manifest",
+            "success",
+        ):
+            self._send_chunk({"status": status})
+        self._end_stream()
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request: object, client_address: object) -> None:
+        # Clients closing connections early are expected
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--port", type=int, default=sllm.common.API_PORT)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.05,
+        help="seconds before the first token",
+    )
+    parser.add_argument(
+        "--tokens", type=int, default=32, help="tokens per answer"
+    )
+    parser.add_argument("--tokens-per-second", type=float, default=200)
+    parser.add_argument(
+        "--load-time", type=float, default=0.5, help="seconds to load the model"
+    )
+    parser.add_argument(
+        "--failure-rate",
+        type=float,
+        default=0.0,
+        help="fraction of requests that fail",
+    )
+    parser.add_argument(
+        "--parallel", type=int, default=1, help="requests generated at once"
+    )
+    parser.add_argument(
+        "--max-queue",
+        type=int,
+        default=512,
+        help="requests waiting for a slot before the server refuses more",
+    )
+    parser.add_argument(
+        "--interrupt-pull",
+        action="store_true",
+        help="break off the first download of every model",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    Handler.model = Model(args)
+    server = Server(("127.0.0.1", args.port), Handler)
+    print(f"Serving fake ollama at http://127.0.0.1:{args.port}.", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""Drive sllm requests at high concurrency and measure client overhead.
+
+Client overhead is the time the caller waited on top of the time the
+server spent on the request, as reported in the response. It covers
+connection handling, the broker, response parsing and queueing in the
+client. Run it against 'tools/fake_ollama.py' to get numbers that do
+not depend on a model:
+
+    $ python tools/fake_ollama.py --parallel 8 &
+    $ python tools/load_test.py --requests 500 --concurrency 8
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--no-stream", action="store_true", help="send non-streaming requests"
+    )
+    parser.add_argument(
+        "--spawn",
+        action="store_true",
+        help="start 'tools/fake_ollama.py' for the duration of the test",
+    )
+    parser.add_argument("--json", action="store_true", help="print JSON report")
+    args, server_args = parser.parse_known_args()
+
+    # Keep the caches and statistics of the user out of the test
+    state = tempfile.TemporaryDirectory(prefix="sllm-load-")
+    os.environ["XDG_CACHE_HOME"] = state.name
+    os.environ["XDG_RUNTIME_DIR"] = state.name
+
+    server: subprocess.Popen | None = None
+    if args.spawn:
+        server = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.join(os.path.dirname(__file__), "fake_ollama.py"),
+            ]
+            + [f"--parallel={args.concurrency}"]
+            + server_args,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        # Wait until the server listens
+        assert server.stdout is not None
+        server.stdout.readline()
+
+    try:
+        report: dict = run(args)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        state.cleanup()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            print(f"{key:<24} {value}")
+    return 1 if report["errors"] else 0
+
+
+def run(args: argparse.Namespace) -> dict:
+    start: float = time.monotonic()
+    import sllm.api
+    import sllm.metrics
+
+    import_time: float = time.monotonic() - start
+
+    start = time.monotonic()
+    if not sllm.api.ok():
+        raise RuntimeError("Server is not ready.")
+    ready_time: float = time.monotonic() - start
+
+    def one(i: int) -> tuple[float, float]:
+        request = sllm.api.Request(
+            "You are a load test.", f"Request number {i}.", cache=False
+        )
+        begin: float = time.monotonic()
+        if args.no_stream:
+            request.send()
+        else:
+            for _ in request.stream():
+                pass
+        wall: float = time.monotonic() - begin
+        assert request.stats is not None
+        return wall, wall - request.stats.total_duration / 10**9
+
+    walls: list[float] = []
+    overheads: list[float] = []
+    errors: int = 0
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(args.concurrency) as pool:
+        futures = [pool.submit(one, i) for i in range(args.requests)]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                wall, overhead = future.result()
+            except Exception as exc:
+                print(f"Request failed: {exc}", file=sys.stderr)
+                errors += 1
+                continue
+            walls.append(wall)
+            overheads.append(overhead)
+    elapsed: float = time.monotonic() - start
+
+    def ms(values: list[float], p: int) -> str:
+        value: float | None = sllm.metrics.percentile(values, p)
+        return "-" if value is None else f"{value * 1000:.1f} ms"
+
+    return {
+        "import": f"{import_time * 1000:.1f} ms",
+        "first readiness check": f"{ready_time * 1000:.1f} ms",
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "errors": errors,
+        "requests per second": round(len(walls) / elapsed, 1),
+        "wall p50": ms(walls, 50),
+        "wall p95": ms(walls, 95),
+        "wall p99": ms(walls, 99),
+        "client overhead p50": ms(overheads, 50),
+        "client overhead p95": ms(overheads, 95),
+        "client overhead p99": ms(overheads, 99),
+    }
+
+
+if __name__ == "__main__":
+    sys.exit(main())
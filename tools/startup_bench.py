@@ -0,0 +1,160 @@
+"""Measure how long the command line tools take to start.
+
+Every scenario runs in a fresh interpreter, the way the git hook runs
+the tools. The time on top of starting a bare interpreter is
+compared to a threshold, and none of the scenarios may import the HTTP
+client, as none of them talk to the server:
+
+    $ python tools/startup_bench.py --runs 20 --threshold 150
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+# Modules that are only needed to talk to the server
+NETWORK_MODULES: tuple[str, ...] = ("requests", "urllib3", "sllm.client")
+
+MESSAGE: str = "Fix typo in README\n\nThe word 'recieve' was misspelled."
+REVIEW: str = "1. Title: The title is fine."
+
+
+def _tool(module: str) -> list[str]:
+    code: str = f"import sys, {module}; sys.exit({module}.main())"
+    return [sys.executable, "-c", code]
+
+
+def scenarios(directory: str) -> dict[str, list[str]]:
+    """Commands to measure, by name.
+
+    :param directory: Directory with the inputs, see 'prepare()'.
+    """
+    message: str = os.path.join(directory, "message")
+    empty: str = os.path.join(directory, "empty")
+    return {
+        "sllm --help": [sys.executable, "-m", "sllm", "--help"],
+        # Runs past argument parsing, as the idle timer does every minute
+        "sllm --stop-idle": [sys.executable, "-m", "sllm", "--stop-idle"],
+        "sllm-git-message --help": _tool("_sllm_git_message") + ["--help"],
+        "sllm-git-message, empty": _tool("_sllm_git_message")
+        + ["--file", empty],
+        "sllm-git-message, cached": _tool("_sllm_git_message")
+        + ["--file", message],
+        "sllm-translate --help": _tool("_sllm_translate") + ["--help"],
+    }
+
+
+def prepare(directory: str) -> None:
+    """Write the inputs and put the review of the message into the cache.
+
+    The server is marked as just used, so that '--stop-idle' keeps it.
+    """
+    with open(os.path.join(directory, "message"), "w") as handle:
+        handle.write(MESSAGE + "\n")
+    with open(os.path.join(directory, "empty"), "w") as handle:
+        handle.write("# Only a comment\n")
+
+    import _sllm_git_message
+    import sllm.activity
+    import sllm.cache
+    import sllm.common
+
+    sllm.activity.touch()
+
+    payload: dict = _sllm_git_message.build_request(
+        MESSAGE, cache=True
+    )._build()
+    cache = sllm.cache.Cache()
+    try:
+        cache.set_digest(sllm.common.MODEL, "startup-bench")
+        cache.put(sllm.cache.key("startup-bench", payload), REVIEW)
+    finally:
+        cache.close()
+
+
+def imported(command: list[str]) -> list[str]:
+    """Run the command once and list the network modules it imported."""
+    proc = subprocess.run(
+        [command[0], "-X", "importtime"] + command[1:],
+        capture_output=True,
+        text=True,
+    )
+    names: set[str] = {
+        line.rsplit("|", 1)[-1].strip()
+        for line in proc.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+    return [name for name in NETWORK_MODULES if name in names]
+
+
+def measure(command: list[str], runs: int) -> float:
+    """Run the command repeatedly.
+
+    :returns: Median wall time, in seconds.
+    """
+    times: list[float] = []
+    for _ in range(runs):
+        start: float = time.perf_counter()
+        proc = subprocess.run(command, capture_output=True)
+        times.append(time.perf_counter() - start)
+        if proc.returncode != 0:
+            raise RuntimeError(
+                f"{command} failed: {proc.stderr.decode().strip()}"
+            )
+    return statistics.median(times)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=200,
+        help="milliseconds allowed on top of a bare interpreter",
+    )
+    parser.add_argument("--json", action="store_true", help="print JSON report")
+    args = parser.parse_args()
+
+    # Keep the caches and statistics of the user out of the benchmark
+    state = tempfile.TemporaryDirectory(prefix="sllm-startup-")
+    os.environ["XDG_CACHE_HOME"] = state.name
+    os.environ["XDG_RUNTIME_DIR"] = state.name
+    try:
+        prepare(state.name)
+        baseline: float = measure([sys.executable, "-c", "pass"], args.runs)
+        report: dict = {"interpreter": round(baseline * 1000, 1)}
+        failed: list[str] = []
+        for name, command in scenarios(state.name).items():
+            overhead: float = (measure(command, args.runs) - baseline) * 1000
+            network: list[str] = imported(command)
+            report[name] = {
+                "overhead": round(overhead, 1),
+                "network_modules": network,
+            }
+            if overhead > args.threshold:
+                failed.append(f"{name} took {overhead:.0f} ms")
+            if network:
+                failed.append(f"{name} imported {', '.join(network)}")
+    finally:
+        state.cleanup()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{'interpreter':<32} {report.pop('interpreter'):8.1f} ms")
+        for name, result in report.items():
+            print(f"{name:<32} {result['overhead']:+8.1f} ms")
+    for failure in failed:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())